@@ -3,32 +3,121 @@ from controllers.emotion_controller import create_emotion_blueprint
 from controllers.user_controller import create_user_blueprint
 from controllers.classroom_controller import create_classroom_blueprint
 from controllers.session_controller import create_session_blueprint
+from controllers.stream_controller import register_stream_handlers
+from controllers.metrics_controller import create_metrics_blueprint
 from dotenv import load_dotenv
 import os
 from pymongo import MongoClient
 from flask_cors import CORS
+from flask_socketio import SocketIO
+from face_index import FaceIndex
+from model_registry import ModelRegistry
+from inference_pool import InferencePool
+from micro_batcher import MicroBatcher
+from user_utils import user_cache
+from frame_pipeline import FramePipeline
+from detector_selector import DetectorSelector
+from process_inference import InferenceProcesses
 
-# Load environment variables
-load_dotenv()
+def create_app():
+    # Load environment variables
+    load_dotenv()
 
-# Initialize the Flask application
-app = Flask(__name__)
+    # Initialize the Flask application
+    app = Flask(__name__)
 
-# Enable CORS
-CORS(app)
+    # Enable CORS
+    CORS(app)
 
-# Load configuration from config.py
-app.config.from_object('config.Config')
+    # WebSocket support for streaming ingestion
+    socketio = SocketIO(app, cors_allowed_origins='*')
 
-# Configure MongoDB
-client = MongoClient(app.config['MONGO_URI'])
-db = client[app.config['MONGO_DB_NAME']]
+    # Load configuration from config.py
+    app.config.from_object('config.Config')
 
-# Register blueprints
-app.register_blueprint(create_emotion_blueprint(db, app.config), url_prefix='/emotion')
-app.register_blueprint(create_user_blueprint(db, app.config), url_prefix='/user')
-app.register_blueprint(create_classroom_blueprint(db, app.config), url_prefix='/classroom')
-app.register_blueprint(create_session_blueprint(db, app.config), url_prefix='/session')
+    # Configure MongoDB
+    client = MongoClient(app.config['MONGO_URI'])
+    db = client[app.config['MONGO_DB_NAME']]
+
+    # Size the cache of authenticated users
+    user_cache.configure(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+    # Load and warm up the models before any request can reach them
+    model_registry = ModelRegistry(
+        detector_backends=app.config['PRELOAD_DETECTOR_BACKENDS'],
+        recognition_model=app.config['FACE_MODEL_NAME']
+    ).load()
+
+    # Shared bounded pool for all inference work
+    inference_pool = InferencePool(
+        max_workers=app.config['INFERENCE_WORKERS'],
+        max_queue=app.config['INFERENCE_QUEUE_DEPTH']
+    )
+
+    # Emotion and gender classification batched across concurrent requests
+    emotion_batcher = MicroBatcher(
+        model_registry.predict_emotion_gender,
+        max_batch_size=app.config['EMOTION_BATCH_MAX_SIZE'],
+        window_ms=app.config['EMOTION_BATCH_WINDOW_MS']
+    )
+
+    # Resident gallery of enrolled face embeddings, memory-mapped from GALLERY_DIR when set
+    face_index = FaceIndex(
+        db['users'],
+        model_name=app.config['FACE_MODEL_NAME'],
+        detector_backend=app.config['FACE_DETECTOR_BACKEND'],
+        threshold=app.config['FACE_MATCH_THRESHOLD'],
+        gallery_dir=app.config['GALLERY_DIR'] or None,
+        nprobe=app.config['GALLERY_NPROBE'],
+        ivf_min_rows=app.config['GALLERY_IVF_MIN_ROWS'],
+        ivf_lists=app.config['GALLERY_IVF_LISTS'],
+        refresh_seconds=app.config['GALLERY_REFRESH_SECONDS']
+    )
+    if app.config['FACE_REEMBED_ON_STARTUP']:
+        face_index.reembed_outdated_in_background()
+
+    # Detector latencies measured on this host, used to pick a backend per request
+    detector_selector = DetectorSelector(
+        model_registry,
+        inference_pool,
+        sample_size=(app.config['DETECTION_MAX_DIMENSION'], app.config['DETECTION_MAX_DIMENSION'] * 3 // 4),
+        sample_image=app.config['DETECTOR_BENCHMARK_IMAGE']
+    )
+    if app.config['DETECTOR_BENCHMARK_ON_STARTUP']:
+        detector_selector.benchmark(model_registry.detector_backends)
+
+    # Optional tier of inference processes, fed through shared memory by the pool's threads
+    inference_processes = None
+    if app.config['INFERENCE_PROCESSES'] > 0:
+        inference_processes = InferenceProcesses(
+            app.config,
+            processes=app.config['INFERENCE_PROCESSES'],
+            slots=app.config['INFERENCE_WORKERS'],
+            threads=app.config['INFERENCE_PROCESS_THREADS'],
+            detector_backends=app.config['PRELOAD_DETECTOR_BACKENDS']
+        )
+        inference_processes.start()
+
+    # Frame analysis shared by the HTTP and streaming endpoints
+    frame_pipeline = FramePipeline(db, app.config, face_index, model_registry, inference_pool, emotion_batcher, detector_selector, inference_processes)
+
+    # Register blueprints
+    app.register_blueprint(create_emotion_blueprint(db, app.config, frame_pipeline), url_prefix='/emotion')
+    app.register_blueprint(create_user_blueprint(db, app.config, face_index), url_prefix='/user')
+    app.register_blueprint(create_classroom_blueprint(db, app.config), url_prefix='/classroom')
+    app.register_blueprint(create_session_blueprint(db, app.config), url_prefix='/session')
+    app.register_blueprint(create_metrics_blueprint(app.config, frame_pipeline))
+
+    # Register streaming handlers
+    register_stream_handlers(socketio, db, app.config, frame_pipeline)
+
+    return app, socketio
+
+# Inference worker processes are spawned and re-import this module as
+# __mp_main__; only the server process builds the app
+if __name__ != '__mp_main__':
+    app, socketio = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=app.config['DEBUG'], host='0.0.0.0', port=app.config['PORT'])
\ No newline at end of file
+    # Same development server as app.run, now serving the WebSocket endpoint too
+    socketio.run(app, debug=app.config['DEBUG'], host='0.0.0.0', port=app.config['PORT'], allow_unsafe_werkzeug=True)
\ No newline at end of file
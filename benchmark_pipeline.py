@@ -0,0 +1,295 @@
+import argparse
+import base64
+import datetime
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+# Replays a directory of recorded frames through the analysis stages without
+# Flask or MongoDB and reports per-stage p50/p95/p99 latency, frames per second
+# and peak memory for every detector backend and frame size.
+#
+#     python benchmark_pipeline.py frames/ --detectors opencv,mtcnn --sizes 640,1280 --output bench.json
+#     python benchmark_pipeline.py frames/ --baseline bench.json
+#
+# --gallery points at a directory with one subdirectory of images per person.
+# Without it the identification stage matches against --gallery-size random
+# embeddings, which costs the same as a real gallery of that size.
+
+STAGES = ['decode', 'preprocess', 'detect', 'crop', 'classify', 'identify', 'draw', 'encode']
+IMAGE_EXTENSIONS = ('*.jpg', '*.jpeg', '*.png')
+GALLERY_ROLE = 'student'
+GALLERY_GENDER = 'benchmark'
+
+
+def load_frames(directory, limit=None):
+    paths = sorted(path for pattern in IMAGE_EXTENSIONS for path in glob.glob(os.path.join(directory, pattern)))
+    if limit:
+        paths = paths[:limit]
+    frames = []
+    for path in paths:
+        with open(path, 'rb') as image_file:
+            frames.append(image_file.read())
+    return frames
+
+
+def resize_encoded(data, size):
+    # Re-encode a recorded frame with its longest side at `size`, so decode is
+    # measured on what a camera of that resolution would send
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    height, width = img.shape[:2]
+    factor = size / max(height, width)
+    if factor != 1:
+        interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_LINEAR
+        img = cv2.resize(img, (max(int(width * factor), 1), max(int(height * factor), 1)), interpolation=interpolation)
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+
+def percentiles(samples):
+    if not samples:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'mean_ms': None}
+    milliseconds = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+    return {
+        'p50_ms': round(float(p50), 2),
+        'p95_ms': round(float(p95), 2),
+        'p99_ms': round(float(p99), 2),
+        'mean_ms': round(float(milliseconds.mean()), 2)
+    }
+
+
+def build_gallery(face_index, directory, gallery_size, dimension):
+    if directory:
+        embeddings = []
+        user_ids = []
+        image_paths = []
+        for person in sorted(os.listdir(directory)):
+            for pattern in IMAGE_EXTENSIONS:
+                for image_path in sorted(glob.glob(os.path.join(directory, person, pattern))):
+                    embedding = face_index.embed_image(image_path)
+                    if embedding is not None:
+                        embeddings.append(embedding)
+                        user_ids.append(person)
+                        image_paths.append(image_path)
+        face_index.set_partition(GALLERY_ROLE, GALLERY_GENDER, np.asarray(embeddings, dtype=np.float32), user_ids, image_paths)
+        return len(user_ids)
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((gallery_size, dimension)).astype(np.float32)
+    face_index.set_partition(GALLERY_ROLE, GALLERY_GENDER, embeddings, [f'user-{i}' for i in range(gallery_size)])
+    return gallery_size
+
+
+def reset_peak_rss():
+    # On Linux writing 5 to clear_refs resets the VmHWM high-water mark to the
+    # current resident memory, so each run reports its own peak. Returns False
+    # where it can't be reset.
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    # High-water mark of the resident memory, so peaks inside a stage count
+    # too: VmHWM since reset_peak_rss on Linux, otherwise ru_maxrss, the peak of
+    # the whole process including model loading and earlier runs
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_frames(pipeline, face_index, frames, detector_backend, warmup, jpeg_quality, max_dimension):
+    timings = {stage: [] for stage in STAGES}
+    peak_rss_per_run = reset_peak_rss()
+    faces = 0
+    measured = 0
+    measured_seconds = 0.0
+
+    for number, data in enumerate(frames):
+        times = {}
+
+        def timed(stage, fn, *args, **kwargs):
+            started = time.perf_counter()
+            result = fn(*args, **kwargs)
+            times[stage] = time.perf_counter() - started
+            return result
+
+        frame_started = time.perf_counter()
+        img_array, _ = timed('decode', pipeline.decode_image, data)
+        if img_array is None:
+            continue
+        preprocessed_img, _, _ = timed('preprocess', pipeline.preprocess_image, img_array)
+        boxes, _ = timed('detect', pipeline.detect_faces, preprocessed_img, detector_backend)
+        crops = timed('crop', pipeline.crop_faces, img_array, preprocessed_img.shape, boxes)
+        keep = [i for i, crop in enumerate(crops) if crop.size > 0]
+        boxes = [boxes[i] for i in keep]
+        crops = [crops[i] for i in keep]
+        results = timed('classify', pipeline.classify_crops, crops)
+
+        def identify():
+            if not crops:
+                return []
+            return face_index.match(face_index.embed_crops(crops), GALLERY_ROLE, GALLERY_GENDER)
+        timed('identify', identify)
+
+        emotions, _ = pipeline.build_emotions(boxes, crops, results, encode_faces=False)
+        for emotion in emotions:
+            emotion['identified_user'] = None
+        scale_x = img_array.shape[1] / preprocessed_img.shape[1]
+        scale_y = img_array.shape[0] / preprocessed_img.shape[0]
+        annotated_img = timed('draw', pipeline.render_annotated, img_array, emotions, scale_x, scale_y, max_dimension)
+
+        def encode():
+            # The annotated frame plus the face crops of the full response
+            pipeline.encode_jpeg(annotated_img, jpeg_quality)
+            for crop in crops:
+                base64.b64encode(cv2.imencode('.jpg', crop)[1])
+        timed('encode', encode)
+        frame_seconds = time.perf_counter() - frame_started
+
+        if number < warmup:
+            continue
+        measured += 1
+        measured_seconds += frame_seconds
+        faces += len(emotions)
+        for stage, seconds in times.items():
+            timings[stage].append(seconds)
+
+    return {
+        'frames': measured,
+        'faces': faces,
+        'fps': round(measured / measured_seconds, 2) if measured_seconds else None,
+        'peak_rss_bytes': peak_rss_bytes(),
+        # False when the peak includes everything the process did before this run
+        'peak_rss_per_run': peak_rss_per_run,
+        'stages': {stage: percentiles(samples) for stage, samples in timings.items()},
+        'total': percentiles([sum(stage_times) for stage_times in zip(*timings.values())])
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_summary(runs):
+    for run in runs:
+        print(f"{run['detector_backend']} @ {run['size']}px: {run['frames']} frames, {run['faces']} faces, "
+              f"{run['fps']} fps, peak RSS {run['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+        for stage in STAGES + ['total']:
+            stats = run['total'] if stage == 'total' else run['stages'][stage]
+            print(f"    {stage:<10} p50 {stats['p50_ms']} ms  p95 {stats['p95_ms']} ms  p99 {stats['p99_ms']} ms")
+
+
+def print_comparison(runs, baseline):
+    # p95 and fps against an earlier results file, per detector backend and size
+    previous = {(run['detector_backend'], run['size']): run for run in baseline.get('runs', [])}
+    print(f"Compared with {baseline.get('commit') or 'baseline'}:")
+    for run in runs:
+        before = previous.get((run['detector_backend'], run['size']))
+        if before is None:
+            continue
+        print(f"{run['detector_backend']} @ {run['size']}px: fps {before['fps']} -> {run['fps']}")
+        for stage in STAGES:
+            old = before['stages'].get(stage, {}).get('p95_ms')
+            new = run['stages'][stage]['p95_ms']
+            if old and new is not None:
+                print(f"    {stage:<10} p95 {old} -> {new} ms ({(new - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the frame analysis stages on recorded frames')
+    parser.add_argument('frames', help='Directory of recorded frames (jpg or png)')
+    parser.add_argument('--detectors', default='opencv,mtcnn', help='Comma separated detector backends')
+    parser.add_argument('--sizes', default='640,1280', help='Comma separated longest sides to resize the frames to')
+    parser.add_argument('--limit', type=int, help='Use only the first N frames')
+    parser.add_argument('--warmup', type=int, default=3, help='Frames per run left out of the results')
+    parser.add_argument('--gallery', help='Directory with one subdirectory of face images per person')
+    parser.add_argument('--gallery-size', type=int, default=1000, help='Random gallery rows when --gallery is not given')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    load_dotenv()
+    # Config reads the environment on import, so load it after the .env file
+    from config import Config
+    from face_index import FaceIndex
+    from frame_pipeline import FramePipeline
+    from micro_batcher import MicroBatcher
+    from model_registry import ModelRegistry, current_rss_bytes
+
+    config = {key: getattr(Config, key) for key in dir(Config) if key.isupper()}
+    detectors = [detector for detector in args.detectors.split(',') if detector]
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+
+    frames = load_frames(args.frames, args.limit)
+    if not frames:
+        print(f"No frames found in {args.frames}")
+        return
+
+    model_registry = ModelRegistry(detector_backends=detectors, recognition_model=Config.FACE_MODEL_NAME).load()
+    rss_after_load = current_rss_bytes()
+    # No batching window: each frame's faces go to the models right away
+    emotion_batcher = MicroBatcher(model_registry.predict_emotion_gender, max_batch_size=Config.EMOTION_BATCH_MAX_SIZE, window_ms=0)
+    face_index = FaceIndex(None, model_name=Config.FACE_MODEL_NAME, detector_backend=Config.FACE_DETECTOR_BACKEND, threshold=Config.FACE_MATCH_THRESHOLD)
+    pipeline = FramePipeline(None, config, face_index, model_registry, None, emotion_batcher)
+
+    model = model_registry.get(Config.FACE_MODEL_NAME, 'facial_recognition')
+    gallery_rows = build_gallery(face_index, args.gallery, args.gallery_size, model.output_shape)
+
+    runs = []
+    for size in sizes:
+        resized = [frame for frame in (resize_encoded(data, size) for data in frames) if frame is not None]
+        for detector_backend in detectors:
+            print(f"Running {detector_backend} on {len(resized)} frames at {size}px")
+            run = run_frames(
+                pipeline, face_index, resized, detector_backend, args.warmup,
+                Config.RESPONSE_JPEG_QUALITY, Config.RESPONSE_MAX_DIMENSION
+            )
+            run.update({'detector_backend': detector_backend, 'size': size})
+            runs.append(run)
+
+    results = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'frames_directory': args.frames,
+        'gallery_rows': gallery_rows,
+        'rss_after_load_bytes': rss_after_load,
+        'config': {key: config[key] for key in ('ANALYSIS_MAX_DIMENSION', 'DETECTION_MAX_DIMENSION', 'FACE_MODEL_NAME', 'RESPONSE_JPEG_QUALITY', 'RESPONSE_MAX_DIMENSION')},
+        'runs': runs
+    }
+
+    print_summary(runs)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            print_comparison(runs, json.load(baseline_file))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
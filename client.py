@@ -1,68 +1,257 @@
+import argparse
+import collections
+import threading
+import time
 import cv2
 import numpy as np
-import base64
 import requests
-import threading
+from requests.adapters import HTTPAdapter
+
+# Streams a camera (or video file) to /emotion/process_frame and shows the
+# annotated frames next to the live ones.
+#
+#     python client.py --token <jwt> --session-id <id> --student-id <id>
+#
+# One thread captures, keeping only the newest frames in a small queue. A few
+# sender threads each keep a connection open and upload downscaled JPEGs, at a
+# rate that slows down when the server's reported latency goes over the target.
+
+
+class LatestFrames:
+    # Bounded queue that drops the oldest frame when full, so senders always
+    # get the freshest frame instead of a growing backlog
+    def __init__(self, size):
+        self._frames = collections.deque(maxlen=size)
+        self._condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._condition:
+            if len(self._frames) == self._frames.maxlen:
+                self.dropped += 1
+            self._frames.append(item)
+            self._condition.notify()
+
+    def get(self, timeout=1.0):
+        with self._condition:
+            if not self._frames:
+                self._condition.wait(timeout)
+            return self._frames.popleft() if self._frames else None
+
+
+class AdaptiveRate:
+    # Spacing between uploads shared by all senders: backs off multiplicatively
+    # when the server is slower than the target or overloaded, and speeds up
+    # step by step while it keeps up
+    def __init__(self, max_fps, target_latency):
+        self.min_interval = 1.0 / max_fps
+        self.max_interval = 2.0
+        self.target_latency = target_latency
+        self.interval = self.min_interval
+        self._next_send = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(self._next_send, now)
+            self._next_send = send_at + self.interval
+        time.sleep(send_at - now)
+
+    def update(self, server_latency):
+        with self._lock:
+            if server_latency > self.target_latency:
+                self.interval = min(self.interval * 1.5, self.max_interval)
+            else:
+                self.interval = max(self.interval - self.min_interval * 0.1, self.min_interval)
+
+    def back_off(self, seconds):
+        with self._lock:
+            self.interval = min(self.interval * 2, self.max_interval)
+            self._next_send = max(self._next_send, time.monotonic() + seconds)
+
+    def fps(self):
+        return 1.0 / self.interval
+
+
+class ClientStats:
+    def __init__(self, window=200):
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.faces = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._server_latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._since = time.monotonic()
+        self._received_since = 0
+
+    def record_sent(self):
+        with self._lock:
+            self.sent += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record(self, latency, server_latency, faces):
+        with self._lock:
+            self.received += 1
+            self.faces += faces
+            self._latencies.append(latency)
+            if server_latency is not None:
+                self._server_latencies.append(server_latency)
+
+    def report(self, dropped, send_fps):
+        with self._lock:
+            now = time.monotonic()
+            fps = (self.received - self._received_since) / (now - self._since)
+            self._since, self._received_since = now, self.received
+            latencies = np.array(self._latencies) * 1000
+            server_latencies = np.array(self._server_latencies) * 1000
+        line = f"fps {fps:.1f} (target {send_fps:.1f}), sent {self.sent}, received {self.received}, errors {self.errors}, dropped {dropped}"
+        if latencies.size:
+            line += f", end-to-end p50 {np.percentile(latencies, 50):.0f}ms p95 {np.percentile(latencies, 95):.0f}ms"
+        if server_latencies.size:
+            line += f", server p50 {np.percentile(server_latencies, 50):.0f}ms"
+        print(line)
 
-def decode_image(base64_string):
-    img_data = base64.b64decode(base64_string)
-    np_arr = np.frombuffer(img_data, np.uint8)
-    img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-    return img
-
-def analyze_frame(frame):
-    _, img_encoded = cv2.imencode('.jpg', frame)
-    img_base64 = base64.b64encode(img_encoded).decode('utf-8')
-    response = requests.post(
-        'http://localhost:3001/emotion/process_frame',
-        files={
-            'image': ('frame.jpg', base64.b64decode(img_base64), 'image/jpeg'),
-            'detector_backend': (None, 'mctnn')
-        }
-    )
-    return response.json()
-
-def capture_video():
-    cap = cv2.VideoCapture(0)
-    processed_frame = None
-
-    def update_processed_frame():
-        nonlocal processed_frame
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            result = analyze_frame(frame)
-            if 'processed_image' in result:
-                try:
-                    processed_frame = decode_image(result['processed_image'])
-                except Exception as e:
-                    print(e)
-
-    threading.Thread(target=update_processed_frame, daemon=True).start()
-
-    while True:
+
+def server_total(response):
+    # The 'total' span of the Server-Timing header, in seconds
+    for span in response.headers.get('Server-Timing', '').split(','):
+        name, _, params = span.strip().partition(';')
+        if name == 'total' and params.startswith('dur='):
+            return float(params[4:]) / 1000
+    return None
+
+
+def downscale(frame, max_dimension):
+    height, width = frame.shape[:2]
+    longest = max(height, width)
+    if not max_dimension or longest <= max_dimension:
+        return frame
+    factor = max_dimension / longest
+    return cv2.resize(frame, (int(width * factor), int(height * factor)), interpolation=cv2.INTER_AREA)
+
+
+def capture_frames(cap, frames, latest, stop):
+    # The only reader of the capture device
+    while not stop.is_set():
         ret, frame = cap.read()
         if not ret:
             break
+        latest['frame'] = frame
+        frames.put((time.monotonic(), frame))
+    stop.set()
 
-        # Create a blank image to combine both frames
-        combined_frame = np.zeros((frame.shape[0], frame.shape[1] * 2, frame.shape[2]), dtype=np.uint8)
 
-        # Place the real-time frame on the left
-        combined_frame[:, :frame.shape[1]] = frame
+def send_frames(args, frames, rate, stats, latest, stop):
+    # Each sender keeps its own pooled keep-alive connection to the server
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    session.headers['Authorization'] = f'Bearer {args.token}'
+    url = f"{args.url.rstrip('/')}/emotion/process_frame"
+    form = {
+        'session_id': args.session_id,
+        'student_id': args.student_id,
+        'detector_backend': args.detector_backend,
+        'response': 'image'
+    }
 
-        # Place the processed frame on the right if available
-        if processed_frame is not None:
-            combined_frame[:, frame.shape[1]:] = processed_frame
+    while not stop.is_set():
+        rate.wait()
+        item = frames.get()
+        if item is None:
+            continue
+        captured_at, frame = item
+        _, img_encoded = cv2.imencode('.jpg', downscale(frame, args.max_dimension), [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+        stats.record_sent()
+        try:
+            response = session.post(url, data=form, files={'image': ('frame.jpg', img_encoded.tobytes(), 'image/jpeg')}, timeout=args.timeout)
+        except requests.RequestException as e:
+            stats.record_error()
+            print(f"Error sending frame: {e}")
+            rate.back_off(1.0)
+            continue
+
+        if response.status_code == 503:
+            stats.record_error()
+            rate.back_off(float(response.headers.get('Retry-After', 1)))
+            continue
+        server_latency = server_total(response)
+        if server_latency is not None:
+            rate.update(server_latency)
+        if response.status_code == 404:
+            # No faces in the frame, the round trip still counts
+            stats.record(time.monotonic() - captured_at, server_latency, 0)
+            continue
+        if response.status_code != 200:
+            stats.record_error()
+            print(f"Error from server ({response.status_code}): {response.text[:200]}")
+            continue
+
+        processed = cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_COLOR)
+        if processed is not None:
+            latest['processed'] = processed
+        stats.record(time.monotonic() - captured_at, server_latency, int(response.headers.get('X-Faces', 0)))
 
-        # Display the combined frame
-        cv2.imshow('Real-time and Processed Frames', combined_frame)
 
+def capture_video(args):
+    cap = cv2.VideoCapture(int(args.camera) if args.camera.isdigit() else args.camera)
+    frames = LatestFrames(args.queue_size)
+    rate = AdaptiveRate(args.max_fps, args.target_latency_ms / 1000)
+    stats = ClientStats()
+    latest = {'frame': None, 'processed': None}
+    stop = threading.Event()
+
+    threading.Thread(target=capture_frames, args=(cap, frames, latest, stop), daemon=True).start()
+    for _ in range(args.in_flight):
+        threading.Thread(target=send_frames, args=(args, frames, rate, stats, latest, stop), daemon=True).start()
+
+    last_report = time.monotonic()
+    while not stop.is_set():
+        if time.monotonic() - last_report >= args.stats_interval:
+            stats.report(frames.dropped, rate.fps())
+            last_report = time.monotonic()
+
+        frame = latest['frame']
+        if frame is None:
+            time.sleep(0.01)
+            continue
+
+        # Live frame on the left, the latest annotated frame (scaled back up) on the right
+        combined_frame = np.zeros((frame.shape[0], frame.shape[1] * 2, frame.shape[2]), dtype=np.uint8)
+        combined_frame[:, :frame.shape[1]] = frame
+        processed = latest['processed']
+        if processed is not None:
+            combined_frame[:, frame.shape[1]:] = cv2.resize(processed, (frame.shape[1], frame.shape[0]))
+
+        cv2.imshow('Real-time and Processed Frames', combined_frame)
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 
+    stop.set()
+    stats.report(frames.dropped, rate.fps())
     cap.release()
     cv2.destroyAllWindows()
 
-capture_video()
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stream a camera to the emotion tracking server')
+    parser.add_argument('--url', default='http://localhost:3001', help='Server base URL')
+    parser.add_argument('--token', required=True, help='Professor JWT')
+    parser.add_argument('--session-id', required=True)
+    parser.add_argument('--student-id', required=True)
+    parser.add_argument('--camera', default='0', help='Camera index or video file')
+    parser.add_argument('--detector-backend', default='mtcnn', help="Detector backend, or 'auto'")
+    parser.add_argument('--max-dimension', type=int, default=640, help='Longest side of the uploaded frames, 0 keeps the captured size')
+    parser.add_argument('--jpeg-quality', type=int, default=80)
+    parser.add_argument('--in-flight', type=int, default=2, help='Frames uploaded at the same time')
+    parser.add_argument('--queue-size', type=int, default=2, help='Captured frames waiting to be sent, the oldest are dropped')
+    parser.add_argument('--max-fps', type=float, default=15, help='Highest send rate')
+    parser.add_argument('--target-latency-ms', type=float, default=500, help='Server latency above which the send rate backs off')
+    parser.add_argument('--timeout', type=float, default=10, help='Request timeout in seconds')
+    parser.add_argument('--stats-interval', type=float, default=5, help='Seconds between stats lines')
+    capture_video(parser.parse_args())
@@ -5,4 +5,50 @@ class Config:
     DEBUG = os.getenv('DEBUG', True)  # Enable debug mode
     MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
     MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'emotion_db')
-    SECRET_KEY = os.getenv('SECRET_KEY', '123456')
\ No newline at end of file
+    SECRET_KEY = os.getenv('SECRET_KEY', '123456')
+    FACE_MODEL_NAME = os.getenv('FACE_MODEL_NAME', 'VGG-Face')  # Recognition model used for the gallery
+    FACE_DETECTOR_BACKEND = os.getenv('FACE_DETECTOR_BACKEND', 'opencv')  # Detector used to embed gallery images
+    FACE_MATCH_THRESHOLD = float(os.getenv('FACE_MATCH_THRESHOLD')) if os.getenv('FACE_MATCH_THRESHOLD') else None  # Cosine distance cutoff, model default when unset
+    FACE_REEMBED_ON_STARTUP = os.getenv('FACE_REEMBED_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')  # Re-embed users with outdated stored embeddings in the background at startup
+    PRELOAD_DETECTOR_BACKENDS = os.getenv('PRELOAD_DETECTOR_BACKENDS', 'mtcnn,opencv').split(',')  # Detectors loaded and warmed at startup
+    INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', 4))  # Threads running model inference, concurrent frames share classification batches
+    INFERENCE_QUEUE_DEPTH = int(os.getenv('INFERENCE_QUEUE_DEPTH', 8))  # Jobs allowed to wait before requests are rejected
+    EMOTION_BATCH_MAX_SIZE = int(os.getenv('EMOTION_BATCH_MAX_SIZE', 32))  # Faces classified per forward pass
+    EMOTION_BATCH_WINDOW_MS = float(os.getenv('EMOTION_BATCH_WINDOW_MS', 10))  # Time to wait for concurrent requests to join a batch
+    EMOTION_COUNTER_BUCKET_SECONDS = int(os.getenv('EMOTION_COUNTER_BUCKET_SECONDS', 60))  # Time bucket of the per-session emotion counters
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1024))  # Authenticated users kept in memory
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))  # Seconds before a cached user is reloaded
+    TRACKER_KEYFRAME_INTERVAL = int(os.getenv('TRACKER_KEYFRAME_INTERVAL', 10))  # Frames between full detections in tracking mode
+    TRACKER_IOU_THRESHOLD = float(os.getenv('TRACKER_IOU_THRESHOLD', 0.3))  # Overlap needed to carry a track's identity across a keyframe
+    TRACKER_IDLE_SECONDS = float(os.getenv('TRACKER_IDLE_SECONDS', 120))  # Idle time before a stream's tracker is dropped
+    IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 128))  # Recent live embeddings remembered per session
+    IDENTITY_CACHE_IDLE_SECONDS = float(os.getenv('IDENTITY_CACHE_IDLE_SECONDS', 3600))  # Idle time before a session's identity cache is dropped
+    RESPONSE_JPEG_QUALITY = int(os.getenv('RESPONSE_JPEG_QUALITY', 95))  # Quality of the annotated JPEG returned by process_frame, 95 is OpenCV's default
+    RESPONSE_MAX_DIMENSION = int(os.getenv('RESPONSE_MAX_DIMENSION', 0))  # Longest side of the annotated JPEG, 0 keeps the decoded size
+    ANALYSIS_MAX_DIMENSION = int(os.getenv('ANALYSIS_MAX_DIMENSION', 1920))  # Longest side of the decoded frame faces are cropped from (and the annotated JPEG is drawn on), 0 keeps the received size
+    DETECTION_MAX_DIMENSION = int(os.getenv('DETECTION_MAX_DIMENSION', 640))  # Longest side of the downscaled frame the detector runs on
+    DETECTOR_BENCHMARK_ON_STARTUP = os.getenv('DETECTOR_BENCHMARK_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')  # Time the preloaded detectors at startup
+    DETECTOR_BENCHMARK_IMAGE = os.getenv('DETECTOR_BENCHMARK_IMAGE')  # Sample frame for detector benchmarks, random noise when unset
+    PROFILE_SLOW_REQUESTS = os.getenv('PROFILE_SLOW_REQUESTS', 'false').lower() in ('1', 'true', 'yes')  # Sample request stacks and keep the slow ones
+    SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 1.0))  # Requests slower than this get their profile written
+    PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 5))  # Stack sampling interval
+    PROFILE_OUTPUT_DIR = os.getenv('PROFILE_OUTPUT_DIR', 'profiles')  # Where slow request profiles are written
+    INFERENCE_PROCESSES = int(os.getenv('INFERENCE_PROCESSES', 0))  # Worker processes with their own models, 0 runs inference in the server process
+    INFERENCE_PROCESS_THREADS = int(os.getenv('INFERENCE_PROCESS_THREADS', 0))  # Cores (and TensorFlow threads) per worker process, 0 splits the CPUs evenly
+    ASYNC_JOB_DB = os.getenv('ASYNC_JOB_DB', 'frame_jobs.sqlite3')  # Local file holding the frames queued in async mode
+    ASYNC_JOB_WORKERS = int(os.getenv('ASYNC_JOB_WORKERS', 2))  # Background threads analyzing queued frames
+    ASYNC_JOB_MAX_PENDING = int(os.getenv('ASYNC_JOB_MAX_PENDING', 1000))  # Queued frames before async requests are rejected
+    ASYNC_JOB_MAX_WAIT = float(os.getenv('ASYNC_JOB_MAX_WAIT', 30))  # Longest a job poll may wait for the result
+    ASYNC_JOB_RETENTION_SECONDS = float(os.getenv('ASYNC_JOB_RETENTION_SECONDS', 3600))  # How long finished jobs can still be polled
+    ASYNC_JOB_LEASE_SECONDS = float(os.getenv('ASYNC_JOB_LEASE_SECONDS', 60))  # A running job whose process stopped renewing it for this long is queued again
+    VIDEO_UPLOAD_DIR = os.getenv('VIDEO_UPLOAD_DIR', 'video_uploads')  # Where uploaded lecture videos wait to be processed
+    VIDEO_SAMPLE_FPS = float(os.getenv('VIDEO_SAMPLE_FPS', 1))  # Frames analyzed per second of video
+    VIDEO_WORKERS = int(os.getenv('VIDEO_WORKERS', 4))  # Frames of one video analyzed in parallel
+    VIDEO_BATCH_FRAMES = int(os.getenv('VIDEO_BATCH_FRAMES', 30))  # Analyzed frames stored per bulk write and checkpoint
+    VIDEO_MAX_CONCURRENT = int(os.getenv('VIDEO_MAX_CONCURRENT', 1))  # Videos processed at the same time
+    VIDEO_STALE_SECONDS = float(os.getenv('VIDEO_STALE_SECONDS', 300))  # A video job whose server stopped refreshing it for this long is restarted or can be resumed
+    GALLERY_DIR = os.getenv('GALLERY_DIR', '')  # Directory of memory-mapped gallery files shared by all processes, empty keeps the gallery in memory
+    GALLERY_NPROBE = int(os.getenv('GALLERY_NPROBE', 8))  # IVF lists scanned per face, more raises recall and latency
+    GALLERY_IVF_MIN_ROWS = int(os.getenv('GALLERY_IVF_MIN_ROWS', 4096))  # Gallery rows from which a partition gets an IVF index instead of a full scan
+    GALLERY_IVF_LISTS = int(os.getenv('GALLERY_IVF_LISTS', 0))  # IVF lists per partition, 0 uses the square root of its rows
+    GALLERY_REFRESH_SECONDS = float(os.getenv('GALLERY_REFRESH_SECONDS', 30))  # How often a loaded gallery partition is checked for users registered elsewhere, 0 to never
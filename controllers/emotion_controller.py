@@ -1,149 +1,101 @@
 import base64
-import concurrent.futures
-import cv2
+import datetime
+import json
 import uuid
-from flask import Blueprint, request, jsonify
-from PIL import Image
-import numpy as np
-from deepface import DeepFace
-import io
-from user_utils import identify_user, save_emotions_to_user, token_required, is_professor
+from flask import Blueprint, Response, g, request, jsonify, url_for
+from user_utils import token_required, is_professor
+from inference_pool import InferencePoolFull
+from job_queue import FrameJobQueue, JobQueueFull
+from video_processor import VideoProcessor
+from emotion_store import EMOTION_TYPES, save_emotion_batch, session_stats, session_stats_from_counters, session_timeline
+from frame_pipeline import compact_emotions, full_emotions
+from detector_selector import DETECTOR_ACCURACY_ORDER
+from metrics import FRAMES_TOTAL, SESSION_STATS_STUDENTS, SESSION_STATS_TOTAL
 from bson.objectid import ObjectId
-import datetime
 
-def create_emotion_blueprint(db, config):
+def create_emotion_blueprint(db, config, frame_pipeline):
     SECRET_KEY = config['SECRET_KEY']
     # Create a collection for emotions in the database
     emotions_collection = db['emotions']
-    # Create a collection for users in the database
-    users_collection = db['users']
     # Create a collection for sessions in the database
     sessions_collection = db['sessions']
     # Create a collection for classrooms in the database
     classrooms_collection = db['classrooms']
+    # Shared model-side helpers of the frame pipeline
+    model_registry = frame_pipeline.model_registry
+    inference_pool = frame_pipeline.inference_pool
+    emotion_batcher = frame_pipeline.emotion_batcher
+    emotion_events_collection = frame_pipeline.emotion_events_collection
+    emotion_counters_collection = frame_pipeline.emotion_counters_collection
+    detector_selector = frame_pipeline.detector_selector
+    RESPONSE_MODES = ('full', 'results', 'boxes', 'image', 'multipart')
+    JPEG_QUALITY = config['RESPONSE_JPEG_QUALITY']
+    MAX_DIMENSION = config['RESPONSE_MAX_DIMENSION']
     # Create a Flask blueprint for the emotion routes
     emotion_blueprint = Blueprint('emotion', __name__)
+    # Frames accepted in async mode, persisted until a background worker is done with them
+    JOB_RESPONSE_MODES = ('full', 'results', 'boxes')
+    MAX_JOB_WAIT = config['ASYNC_JOB_MAX_WAIT']
+    job_queue = FrameJobQueue(
+        config['ASYNC_JOB_DB'],
+        max_pending=config['ASYNC_JOB_MAX_PENDING'],
+        retention_seconds=config['ASYNC_JOB_RETENTION_SECONDS'],
+        lease_seconds=config['ASYNC_JOB_LEASE_SECONDS']
+    )
+    # Recorded lecture videos, analyzed in the background with resumable progress
+    video_processor = VideoProcessor(db, config, frame_pipeline)
+    VIDEO_SAMPLE_FPS = config['VIDEO_SAMPLE_FPS']
 
-    def preprocess_image(img_array):
-        # Convert the image to grayscale
-        gray = cv2.cvtColor(img_array, cv2.COLOR_BGR2GRAY)
-        # Apply Gaussian blur to the grayscale image
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        # Equalize the histogram of the blurred image
-        equalized = cv2.equalizeHist(blurred)
-        # Convert the equalized image back to BGR color space
-        preprocessed_img = cv2.cvtColor(equalized, cv2.COLOR_GRAY2BGR)
-        # Resize the preprocessed image to half its original size
-        resized_img = cv2.resize(preprocessed_img, (0, 0), fx=0.5, fy=0.5)
-        # Return the resized image and its original dimensions
-        return resized_img, img_array.shape[1], img_array.shape[0]
-
-    def preprocess_image(img_array):
-        # Convert the image to grayscale
-        gray = cv2.cvtColor(img_array, cv2.COLOR_BGR2GRAY)
-        # Apply Gaussian blur to the grayscale image
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        # Equalize the histogram of the blurred image
-        equalized = cv2.equalizeHist(blurred)
-        # Convert the equalized image back to BGR color space
-        preprocessed_img = cv2.cvtColor(equalized, cv2.COLOR_GRAY2BGR)
-        # Resize the preprocessed image to half its original size
-        resized_img = cv2.resize(preprocessed_img, (0, 0), fx=0.5, fy=0.5)
-        # Return the resized image and its original dimensions
-        return resized_img, img_array.shape[1], img_array.shape[0]
-
-    def convert_region_to_box(region):
-        box = {
-            'x': int(region['x']),
-            'y': int(region['y']),
-            'w': int(region['w']),
-            'h': int(region['h']),
-            'left_eye': {
-                'x': int(region['left_eye'][0]),
-                'y': int(region['left_eye'][1])
-            },
-            'right_eye': {
-                'x': int(region['right_eye'][0]),
-                'y': int(region['right_eye'][1])
+    def render_frame(img_array, emotions, scale_x, scale_y, jpeg_quality, max_dimension, timings=None):
+        # Draw boxes and emotions on the image and encode it
+        with frame_pipeline.stage('draw', timings):
+            annotated_img = frame_pipeline.render_annotated(img_array, emotions, scale_x, scale_y, max_dimension)
+        with frame_pipeline.stage('encode', timings):
+            return frame_pipeline.encode_jpeg(annotated_img, jpeg_quality)
+
+    def frame_result(emotions, scale_x, scale_y, decode_factor, detector_backend, response_mode, processed_jpeg=None):
+        if response_mode in ('results', 'boxes'):
+            return {
+                'emotions': compact_emotions(emotions, scale_x * decode_factor, scale_y * decode_factor, include_boxes=response_mode == 'boxes'),
+                'detector_backend': detector_backend
             }
+        # Boxes keep the geometry clients always got: half the received frame
+        return {
+            'emotions': full_emotions(emotions, scale_x * decode_factor / 2, scale_y * decode_factor / 2),
+            'detector_backend': detector_backend,
+            'processed_image': base64.b64encode(processed_jpeg).decode('utf-8')
         }
-        
-        return box
-
-    def analyze_emotion(img_array, detector_backend='mtcnn'):
-        # Analyze the image to detect emotions using DeepFace
-        results = DeepFace.analyze(img_array, actions=['emotion', 'gender'], detector_backend=detector_backend, enforce_detection=False)
-        emotions = []
-        
-        for result in results:
-            # Extract the dominant emotion and its confidence
-            dominant_emotion = result['dominant_emotion']
-            emotion_confidence = result['emotion'][dominant_emotion]
-            dominant_gender = result['dominant_gender']
-            
-            region = result['region']
-            box = convert_region_to_box(region)
-            
-            # Extract the face region from the image
-            _face_region = img_array[box['y']:box['y'] + box['h'], box['x']:box['x'] + box['w']]
-            face_region = base64.b64encode(cv2.imencode('.jpg', _face_region)[1]).decode('utf-8')
-            
-            emotion = {
-                'dominant_emotion': dominant_emotion,
-                'emotion_confidence': emotion_confidence,
-                'dominant_gender': dominant_gender,
-                'box': box,
-                'face_region': face_region,
-            }
-            
-            emotions.append(emotion)
-            
-        return emotions
-
-    def draw_boxes(img_array, emotions, scale_x, scale_y):
-        # Draw rectangles and emotion text on the image
-        for emotion_data in emotions:
-            box = emotion_data['box']
-            x, y, w, h = box['x'], box['y'], box['w'], box['h']
-            x = int(x * scale_x)
-            y = int(y * scale_y)
-            w = int(w * scale_x)
-            h = int(h * scale_y)
-            
-            # Draw rectangle around the face
-            cv2.rectangle(img_array, (x, y), (x + w, y + h), (255, 0, 0), 2)
-            
-            # Draw points for the eyes
-            left_eye_x = box['left_eye'].get('x', 0)
-            left_eye_y = box['left_eye'].get('y', 0)
-            right_eye_x = box['right_eye'].get('x', 0)
-            right_eye_y = box['right_eye'].get('y', 0)
-            
-            
-            radius = 20
 
-            cv2.circle(img_array, (int(left_eye_x * scale_x), int(left_eye_y * scale_y)), radius, (0, 0, 255), -1)
-            cv2.circle(img_array, (int(right_eye_x * scale_x), int(right_eye_y * scale_y)), radius, (0, 0, 255), -1)
-            
-            identified_user = emotion_data['identified_user']
-            emotion_text = f"{emotion_data['dominant_emotion']}"
-            if identified_user:
-                emotion_text = f"{emotion_text} - {identified_user['name']}"
-                
-            font_scale = 4.0  # Increase this value to make the text larger
-            thickness = 2   
-            
-            # Calculate the position for the text
-            text_size, _ = cv2.getTextSize(emotion_text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
-            text_w, text_h = text_size
-            text_x = x
-            text_y = y - 10 if y - 10 > 10 else y + 10
-                
-            # Draw rectangle behind the text
-            cv2.rectangle(img_array, (text_x, text_y - text_h - 5), (text_x + text_w, text_y + 40), (255, 0, 0), -1)
+    def run_frame_job(job):
+        # Same analysis as process_frame, run by the job queue's workers
+        params = job['params']
+        img_array, decode_factor = frame_pipeline.decode_image(job['frame'])
+        if img_array is None or img_array.size == 0:
+            raise ValueError("Invalid image data")
+        detector_backend = frame_pipeline.resolve_detector(params['detector_backend'], params['latency_budget_ms'])
+        emotions, scale_x, scale_y = frame_pipeline.analyze_frame(
+            img_array, detector_backend, encode_faces=params['response'] == 'full', session_id=params['session_id']
+        )
+        FRAMES_TOTAL.inc(source='async')
+        if emotions:
+            # Stamped with the time the frame was accepted, however long it waited
+            accepted_at = datetime.datetime.fromisoformat(params['accepted_at']) if params.get('accepted_at') else datetime.datetime.utcnow()
+            save_emotion_batch(
+                frame_pipeline.emotion_events_collection,
+                frame_pipeline.emotion_counters_collection,
+                params['session_id'],
+                params['student_id'],
+                [(accepted_at, emotions)],
+                frame_pipeline.counter_bucket_seconds,
+                record_write=lambda name, seconds: frame_pipeline.record_stage(name, seconds)
+            )
+        processed_jpeg = None
+        if params['response'] == 'full':
+            processed_jpeg = render_frame(img_array, emotions, scale_x, scale_y, params['jpeg_quality'], params['max_dimension'])
+        return frame_result(emotions, scale_x, scale_y, decode_factor, detector_backend, params['response'], processed_jpeg)
 
-            # Put the emotion text on the image
-            cv2.putText(img_array, emotion_text, (text_x, text_y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (255, 255, 255), thickness)
+    # Jobs wait in the queue while the inference pool is full
+    job_queue.start(run_frame_job, workers=config['ASYNC_JOB_WORKERS'], retry_on=(InferencePoolFull,))
 
     @emotion_blueprint.route('/process_frame', methods=['POST'])
     @token_required(db, SECRET_KEY)
@@ -160,103 +112,98 @@ def create_emotion_blueprint(db, config):
             session_id = request.form.get('session_id')
             student_id = request.form.get('student_id')
             
-            file = request.files['image']
-            image = Image.open(file)
-            img_array = np.array(image)
-            
-            if img_array is None or img_array.size == 0:
-                return jsonify({"error": "Invalid image data"}), 400
+            # Spans of this request, returned in the Server-Timing header
+            timings = g.timings
+            frame = request.files['image'].read()
                 
-            preprocessed_img, original_width, original_height = preprocess_image(img_array)
-            detector_backend = request.form.get('detector_backend', 'mtcnn')
+            # 'auto' or a latency budget in milliseconds picks the backend from the measured latencies
+            requested_backend = request.form.get('detector_backend', 'mtcnn')
+            latency_budget_ms = request.form.get('latency_budget_ms', type=float)
             
-            session = sessions_collection.find_one({'_id': ObjectId(session_id)})
+            # full: emotions with face crops and the annotated frame (default),
+            # results / boxes: JSON only, image: annotated JPEG, multipart: both
+            response_mode = request.form.get('response', 'full')
+            if response_mode not in RESPONSE_MODES:
+                return jsonify({"error": f"response must be one of {', '.join(RESPONSE_MODES)}"}), 400
+            jpeg_quality = min(max(request.form.get('jpeg_quality', JPEG_QUALITY, type=int), 1), 100)
+            max_dimension = request.form.get('max_dimension', MAX_DIMENSION, type=int)
             
-            if not session:
+            with frame_pipeline.stage('mongo_session_lookup', timings):
+                found = frame_pipeline.session_exists(session_id)
+            if not found:
                 return jsonify({"error": "Session not found"}), 404
             
-            # Use a thread pool to analyze the emotion
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(analyze_emotion, preprocessed_img, detector_backend)
-                emotions = future.result()
+            # In async mode the frame is only queued; background workers analyze and store it
+            if request.form.get('async', '').lower() in ('1', 'true', 'yes'):
+                if response_mode not in JOB_RESPONSE_MODES:
+                    return jsonify({"error": f"Async jobs support response {', '.join(JOB_RESPONSE_MODES)}"}), 400
+                if request.form.get('tracking', '').lower() in ('1', 'true', 'yes'):
+                    return jsonify({"error": "Tracking mode needs frames in order and can't be used with async jobs"}), 400
+                try:
+                    job_id = job_queue.enqueue(str(current_user['_id']), {
+                        'session_id': session_id,
+                        'student_id': student_id,
+                        'detector_backend': requested_backend,
+                        'latency_budget_ms': latency_budget_ms,
+                        'response': response_mode,
+                        'jpeg_quality': jpeg_quality,
+                        'max_dimension': max_dimension,
+                        'accepted_at': datetime.datetime.utcnow().isoformat()
+                    }, frame)
+                except JobQueueFull:
+                    return jsonify({"error": "Too many frames waiting, retry later"}), 503, {'Retry-After': '5'}
+                return jsonify({'job_id': job_id, 'status': 'queued'}), 202, {'Location': url_for('emotion.get_job', job_id=job_id)}
             
-            if not emotions:
-                return jsonify({"error": "No emotions detected"}), 404
-
-            scale_x = original_width / preprocessed_img.shape[1]
-            scale_y = original_height / preprocessed_img.shape[0]
+            # Decode straight from the upload, already reduced for analysis where possible
+            img_array, decode_factor = frame_pipeline.decode_image(frame, timings)
             
-            # Process each detected face to identify the user
-            for emotion in emotions:
-                try:
-                    face_region = emotion.get('face_region')
-                    if not face_region:
-                        continue
-                        
-                    face_image = Image.open(io.BytesIO(base64.b64decode(face_region)))
-                    face_img_array = np.array(face_image)
-                    
-                    gender = "female" if emotion.get('dominant_gender') == "Woman" else "male"
-                    identified_user = identify_user(face_img_array, users_collection, gender, 'student')
-                    emotion['identified_user'] = identified_user
-                    
-                    if identified_user:
-                        emotion_data = {
-                            'emotion': emotion['dominant_emotion'],
-                            'timestamp': datetime.datetime.utcnow()
-                        }
-                        
-                        if 'student_emotions' not in session:
-                            session['student_emotions'] = {}
-                            
-                        if student_id in session['student_emotions']:
-                            session['student_emotions'][student_id].append(emotion_data)
-                        else:
-                            session['student_emotions'][student_id] = [emotion_data]
-                except Exception as e:
-                    print(f"Error processing face: {str(e)}")
-                    continue
+            if img_array is None or img_array.size == 0:
+                return jsonify({"error": "Invalid image data"}), 400
             
-            # Update session
+            detector_backend = frame_pipeline.resolve_detector(requested_backend, latency_budget_ms)
+            
+            # In tracking mode faces are followed between keyframes of this session's stream
+            tracker = None
+            if request.form.get('tracking', '').lower() in ('1', 'true', 'yes'):
+                tracker = frame_pipeline.get_tracker((session_id, student_id))
+            
+            # Analyze and identify the faces on the shared inference pool
             try:
-                sessions_collection.update_one(
-                    {'_id': ObjectId(session_id)},
-                    {'$set': {'student_emotions': session.get('student_emotions', {})}}
-                )
-            except Exception as e:
-                print(f"Error updating session: {str(e)}")
+                emotions, scale_x, scale_y = frame_pipeline.analyze_frame(img_array, detector_backend, encode_faces=response_mode == 'full', tracker=tracker, session_id=session_id, timings=timings)
+            except InferencePoolFull as e:
+                return jsonify({"error": "Inference queue is full, retry later"}), 503, {'Retry-After': str(e.retry_after)}
             
-            # Store detected emotions
-            session = sessions_collection.find_one({'_id': ObjectId(session_id)})
+            if not emotions:
+                return jsonify({"error": "No emotions detected"}), 404
             
-            for emotion in emotions:
-                emotion_record = {
-                    'timestamp': datetime.datetime.utcnow(),
-                    'emotion': emotion['dominant_emotion'],
-                    'confidence': emotion['emotion_confidence'],
-                    'student_id': student_id
-                }
-                
-                sessions_collection.update_one(
-                    {'_id': ObjectId(session_id)},
-                    {'$push': {'emotions_data': emotion_record}}
-                )
+            FRAMES_TOTAL.inc(source='http')
+            frame_pipeline.save(session_id, student_id, emotions, timings)
             
-            # Draw boxes and emotions on the image
-            draw_boxes(img_array, emotions, scale_x, scale_y)
+            if response_mode in ('results', 'boxes'):
+                # Nothing to draw or encode
+                return jsonify(frame_result(emotions, scale_x, scale_y, decode_factor, detector_backend, response_mode)), 200
             
-            # Ensure we can encode the image
+            # Ensure we can draw and encode the image
             try:
-                processed_image = base64.b64encode(cv2.imencode('.jpg', img_array)[1]).decode('utf-8')
+                processed_jpeg = render_frame(img_array, emotions, scale_x, scale_y, jpeg_quality, max_dimension, timings)
             except Exception as e:
                 print(f"Error encoding processed image: {str(e)}")
                 return jsonify({"error": "Error encoding processed image"}), 500
+            
+            if response_mode == 'image':
+                return Response(processed_jpeg, mimetype='image/jpeg', headers={'X-Faces': str(len(emotions))})
+            
+            if response_mode == 'multipart':
+                boundary = uuid.uuid4().hex
+                results = json.dumps(frame_result(emotions, scale_x, scale_y, decode_factor, detector_backend, 'boxes')).encode('utf-8')
+                body = b''.join([
+                    f'--{boundary}\r\nContent-Type: application/json\r\n\r\n'.encode('ascii'), results, b'\r\n',
+                    f'--{boundary}\r\nContent-Type: image/jpeg\r\n\r\n'.encode('ascii'), processed_jpeg, b'\r\n',
+                    f'--{boundary}--\r\n'.encode('ascii')
+                ])
+                return Response(body, mimetype=f'multipart/mixed; boundary={boundary}')
                 
-            return jsonify({
-                'emotions': emotions,
-                'detector_backend': detector_backend,
-                'processed_image': processed_image
-            }), 200
+            return jsonify(frame_result(emotions, scale_x, scale_y, decode_factor, detector_backend, response_mode, processed_jpeg)), 200
 
         except Exception as e:
             print(f"Error in process_frame: {str(e)}")
@@ -264,10 +211,41 @@ def create_emotion_blueprint(db, config):
             print(traceback.format_exc())
             return jsonify({"error": "Error analyzing emotion", "message": str(e)}), 500
 
+    @emotion_blueprint.route('/jobs/<job_id>', methods=['GET'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def get_job(current_user, job_id):
+        # ?wait=N holds the request up to N seconds until the job is done
+        wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_JOB_WAIT)
+        job = job_queue.wait(job_id, wait) if wait else job_queue.get(job_id)
+        if job is None or job.pop('owner_id') != str(current_user['_id']):
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job), 200
+
+    @emotion_blueprint.route('/jobs', methods=['GET'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def get_jobs(current_user):
+        return jsonify(job_queue.stats()), 200
+
     @emotion_blueprint.route('/status', methods=['GET'])
     def status():
         return jsonify({"message": "Emotion Tracking Backend Running"}), 200
 
+    @emotion_blueprint.route('/models', methods=['GET'])
+    def get_models():
+        return jsonify(model_registry.stats()), 200
+
+    @emotion_blueprint.route('/stages', methods=['GET'])
+    def get_stages():
+        return jsonify(frame_pipeline.stage_stats()), 200
+
+    @emotion_blueprint.route('/queue', methods=['GET'])
+    def get_queue():
+        stats = inference_pool.stats()
+        stats['emotion_batches'] = emotion_batcher.stats()
+        return jsonify(stats), 200
+
     @emotion_blueprint.route('/detectors', methods=['GET'])
     def get_detectors():
         detectors = {
@@ -297,81 +275,160 @@ def create_emotion_blueprint(db, config):
                 'cons': ['Can be complex to set up']
             }
         }
-        return jsonify({'detectors': detectors}), 200
+        # Latencies measured on this host, for the backends benchmarked so far
+        measurements = detector_selector.measurements() if detector_selector else {}
+        for backend, measurement in measurements.items():
+            detectors.setdefault(backend, {}).update(measurement)
+        return jsonify({'detectors': detectors, 'accuracy_order': DETECTOR_ACCURACY_ORDER}), 200
+
+    @emotion_blueprint.route('/detectors/benchmark', methods=['POST'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def benchmark_detectors(current_user):
+        if detector_selector is None:
+            return jsonify({"error": "Detector selection is disabled"}), 404
+        backends = (request.get_json(silent=True) or {}).get('backends') or DETECTOR_ACCURACY_ORDER
+        unknown = [backend for backend in backends if backend not in DETECTOR_ACCURACY_ORDER]
+        if unknown:
+            return jsonify({"error": f"Unknown detector backends: {', '.join(unknown)}"}), 400
+        return jsonify({'detectors': detector_selector.benchmark(backends)}), 200
+
 
     @emotion_blueprint.route('/session/<session_id>/stats', methods=['GET'])
     @token_required(db, SECRET_KEY)
     @is_professor
     def get_session_stats(current_user, session_id):
         try:
-            session = sessions_collection.find_one({'_id': ObjectId(session_id)})
+            session = sessions_collection.find_one({'_id': ObjectId(session_id)}, {'_id': 1})
             if not session:
                 return jsonify({"error": "Session not found"}), 404
 
-            emotions_data = session.get('emotions_data', [])
-            print("DEBUG: emotions_data count:", len(emotions_data))
-            print("DEBUG: emotions_data sample:", emotions_data[:2])
-
-            # Agrupar emociones por estudiante y ordenar por timestamp
-            stats_by_student = {}
-            for emotion in emotions_data:
-                student_id = emotion.get('student_id')
-                if not student_id or 'emotion' not in emotion or 'timestamp' not in emotion:
-                    continue
-                if student_id not in stats_by_student:
-                    stats_by_student[student_id] = []
-                stats_by_student[student_id].append(emotion)
-
-            # Ordenar emociones por timestamp para cada estudiante
-            for student_id in stats_by_student:
-                stats_by_student[student_id].sort(
-                    key=lambda x: x.get('timestamp')
-                )
+            # Read the running counters, and only aggregate the raw events for
+            # sessions that have no counters yet
+            with frame_pipeline.stage('session_stats_counters', g.timings):
+                final_stats = session_stats_from_counters(emotion_counters_collection, session_id)
+            source = 'counters'
+            if not final_stats:
+                with frame_pipeline.stage('session_stats_events', g.timings):
+                    final_stats = session_stats(emotion_events_collection, session_id)
+                source = 'events'
 
-            final_stats = []
-            emotion_types = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
+            SESSION_STATS_TOTAL.inc(source=source)
+            SESSION_STATS_STUDENTS.observe(len(final_stats))
 
-            for student_id, emotions in stats_by_student.items():
-                if not emotions:
-                    continue
-                mid_point = len(emotions) // 2
-                before_emotions = emotions[:mid_point]
-                after_emotions = emotions[mid_point:]
+            return jsonify({
+                'stats': final_stats,
+                'session_id': session_id,
+                'emotion_types': EMOTION_TYPES
+            }), 200
 
-                before_counts = {emotion: 0 for emotion in emotion_types}
-                after_counts = {emotion: 0 for emotion in emotion_types}
+        except Exception as e:
+            print(f"Error in get_session_stats: {str(e)}")
+            import traceback
+            print(traceback.format_exc())
+            return jsonify({"error": str(e)}), 500
 
-                for e in before_emotions:
-                    emotion = e['emotion'].lower()
-                    if emotion in emotion_types:
-                        before_counts[emotion] += 1
+    @emotion_blueprint.route('/session/<session_id>/identity_cache', methods=['GET'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def get_identity_cache_stats(current_user, session_id):
+        stats = frame_pipeline.identity_cache_stats(session_id)
+        if stats is None:
+            return jsonify({"error": "No identity cache for this session"}), 404
+        stats['session_id'] = session_id
+        return jsonify(stats), 200
 
-                for e in after_emotions:
-                    emotion = e['emotion'].lower()
-                    if emotion in emotion_types:
-                        after_counts[emotion] += 1
+    @emotion_blueprint.route('/session/<session_id>/timeline', methods=['GET'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def get_session_timeline(current_user, session_id):
+        try:
+            interval = request.args.get('interval', 60, type=int)
+            points = request.args.get('points', 200, type=int)
+            student_id = request.args.get('student_id')
+            if not interval or interval <= 0 or not points or points <= 0 or points > 2000:
+                return jsonify({"error": "interval must be positive and points between 1 and 2000"}), 400
 
-                print(f"DEBUG: student_id={student_id} before={before_counts} after={after_counts}")
+            session = sessions_collection.find_one({'_id': ObjectId(session_id)}, {'_id': 1})
+            if not session:
+                return jsonify({"error": "Session not found"}), 404
 
-                final_stats.append({
-                    'student_id': student_id,
-                    'before': before_counts,
-                    'after': after_counts,
-                    'total_frames': len(emotions)
-                })
+            timeline = session_timeline(emotion_events_collection, session_id, interval, points, student_id)
+            timeline['session_id'] = session_id
+            return jsonify(timeline), 200
 
-            print("DEBUG: final_stats:", final_stats)
+        except Exception as e:
+            print(f"Error in get_session_timeline: {str(e)}")
+            import traceback
+            print(traceback.format_exc())
+            return jsonify({"error": str(e)}), 500
 
-            return jsonify({
-                'stats': final_stats,
-                'session_id': session_id,
-                'emotion_types': emotion_types
-            }), 200
+
+    @emotion_blueprint.route('/session/<session_id>/video', methods=['POST'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def upload_session_video(current_user, session_id):
+        try:
+            if 'video' not in request.files:
+                return jsonify({"error": "No video found in request"}), 400
+
+            sample_fps = request.form.get('sample_fps', VIDEO_SAMPLE_FPS, type=float)
+            if not sample_fps or sample_fps <= 0:
+                return jsonify({"error": "sample_fps must be positive"}), 400
+
+            session = sessions_collection.find_one({'_id': ObjectId(session_id)}, {'created_at': 1})
+            if not session:
+                return jsonify({"error": "Session not found"}), 404
+
+            # Wall-clock time of the first frame, the session start by default
+            started_at = session.get('created_at')
+            if request.form.get('started_at'):
+                try:
+                    started_at = datetime.datetime.fromisoformat(request.form['started_at'])
+                except ValueError:
+                    return jsonify({"error": "started_at must be an ISO 8601 date"}), 400
+
+            try:
+                job_id = video_processor.create(
+                    str(current_user['_id']),
+                    session_id,
+                    request.form.get('student_id'),
+                    request.files['video'],
+                    sample_fps,
+                    request.form.get('detector_backend', 'mtcnn'),
+                    started_at
+                )
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            return jsonify({'job_id': str(job_id), 'status': 'queued'}), 202, {'Location': url_for('emotion.get_video_job', job_id=str(job_id))}
 
         except Exception as e:
-            print(f"Error in get_session_stats: {str(e)}")
+            print(f"Error in upload_session_video: {str(e)}")
             import traceback
             print(traceback.format_exc())
             return jsonify({"error": str(e)}), 500
 
-    return emotion_blueprint
\ No newline at end of file
+    @emotion_blueprint.route('/video/<job_id>', methods=['GET'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def get_video_job(current_user, job_id):
+        job = video_processor.get(job_id) if ObjectId.is_valid(job_id) else None
+        if job is None or job.pop('owner_id') != str(current_user['_id']):
+            return jsonify({"error": "Video job not found"}), 404
+        job['job_id'] = str(job.pop('_id'))
+        job['session_id'] = str(job['session_id'])
+        return jsonify(job), 200
+
+    @emotion_blueprint.route('/video/<job_id>/resume', methods=['POST'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def resume_video_job(current_user, job_id):
+        # Continues after the last checkpoint of a failed or interrupted job
+        job = video_processor.get(job_id) if ObjectId.is_valid(job_id) else None
+        if job is None or job['owner_id'] != str(current_user['_id']):
+            return jsonify({"error": "Video job not found"}), 404
+        if not video_processor.resume(job_id):
+            return jsonify({"error": f"Video job is {job['status']} and can't be resumed"}), 409
+        return jsonify({'job_id': job_id, 'status': 'queued', 'checkpoint_frame': job['checkpoint_frame']}), 202
+
+    return emotion_blueprint
@@ -0,0 +1,60 @@
+import time
+from flask import Blueprint, Response, g, request
+from metrics import REQUEST_SECONDS, REQUESTS_TOTAL, Timings, registry
+from model_registry import current_rss_bytes
+from request_profiler import SlowRequestProfiler
+
+def create_metrics_blueprint(config, frame_pipeline):
+    metrics_blueprint = Blueprint('metrics', __name__)
+    inference_pool = frame_pipeline.inference_pool
+    emotion_batcher = frame_pipeline.emotion_batcher
+
+    queue_gauge = registry.gauge('inference_queue_jobs', 'Jobs on the inference pool by state')
+    rejected_gauge = registry.gauge('inference_rejected_jobs', 'Jobs rejected because the inference queue was full')
+    batch_gauge = registry.gauge('emotion_batch_size_avg', 'Average number of faces per emotion batch')
+    rss_gauge = registry.gauge('process_resident_memory_bytes', 'Resident memory of the server process')
+
+    # Optional sampling profiler that keeps the stacks of slow requests
+    profiler = None
+    if config['PROFILE_SLOW_REQUESTS']:
+        profiler = SlowRequestProfiler(
+            output_dir=config['PROFILE_OUTPUT_DIR'],
+            slow_seconds=config['SLOW_REQUEST_SECONDS'],
+            interval_ms=config['PROFILE_INTERVAL_MS']
+        )
+
+    @metrics_blueprint.before_app_request
+    def start_request():
+        g.request_started = time.perf_counter()
+        g.timings = Timings()
+        if profiler:
+            profiler.start()
+
+    @metrics_blueprint.after_app_request
+    def finish_request(response):
+        endpoint = request.endpoint or 'unknown'
+        duration = time.perf_counter() - g.request_started
+        REQUESTS_TOTAL.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        REQUEST_SECONDS.observe(duration, endpoint=endpoint)
+        if g.timings.spans:
+            g.timings.add('total', duration)
+            response.headers['Server-Timing'] = g.timings.header()
+        return response
+
+    @metrics_blueprint.teardown_app_request
+    def teardown_request(error=None):
+        # Also runs when the request failed, so no sampled thread is left behind
+        if profiler:
+            profiler.stop(request.endpoint or 'unknown')
+
+    @metrics_blueprint.route('/metrics', methods=['GET'])
+    def get_metrics():
+        pool_stats = inference_pool.stats()
+        queue_gauge.set(pool_stats['queued'], state='queued')
+        queue_gauge.set(pool_stats['running'], state='running')
+        rejected_gauge.set(pool_stats['rejected'])
+        batch_gauge.set(emotion_batcher.stats()['avg_batch_size'])
+        rss_gauge.set(current_rss_bytes())
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics_blueprint
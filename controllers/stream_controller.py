@@ -0,0 +1,120 @@
+import threading
+import time
+from flask import request
+from user_utils import load_user_from_token
+from inference_pool import InferencePoolFull
+from frame_pipeline import compact_emotions
+from metrics import FRAMES_TOTAL
+
+STREAM_NAMESPACE = '/stream'
+
+def compact_result(frame_number, emotions, scale_x, scale_y, started):
+    # Per-frame result without images
+    return {
+        'frame': frame_number,
+        'faces': compact_emotions(emotions, scale_x, scale_y),
+        'latency_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def register_stream_handlers(socketio, db, config, frame_pipeline):
+    SECRET_KEY = config['SECRET_KEY']
+    # Per-connection state keyed by the Socket.IO session id
+    connections = {}
+
+    @socketio.on('authenticate', namespace=STREAM_NAMESPACE)
+    def authenticate(data):
+        # A professor authenticates once and binds the connection to a session
+        data = data or {}
+        try:
+            current_user = load_user_from_token(db, SECRET_KEY, data.get('token'))
+        except Exception:
+            return {'error': 'Token is invalid!'}
+        if not current_user or current_user.get('role') != 'professor':
+            return {'error': 'Only professors can perform this action!'}
+
+        session_id = data.get('session_id')
+        student_id = data.get('student_id')
+        if not session_id or not student_id:
+            return {'error': 'Missing session_id or student_id'}
+        try:
+            if not frame_pipeline.session_exists(session_id):
+                return {'error': 'Session not found'}
+        except Exception:
+            return {'error': 'Session not found'}
+
+        connections[request.sid] = {
+            'user_id': str(current_user['_id']),
+            'session_id': session_id,
+            'student_id': student_id,
+            'detector_backend': data.get('detector_backend', 'mtcnn'),
+            'latency_budget_ms': data.get('latency_budget_ms'),
+            # The connection owns its tracker, so tracking mode needs no lookup per frame
+            'tracker': frame_pipeline.create_tracker() if data.get('tracking') else None,
+            'lock': threading.Lock(),
+            'busy': False,
+            'pending': None,
+            'received': 0,
+            'processed': 0,
+            'dropped': 0
+        }
+        return {'message': 'Authenticated', 'session_id': session_id}
+
+    @socketio.on('frame', namespace=STREAM_NAMESPACE)
+    def frame(data):
+        state = connections.get(request.sid)
+        if state is None:
+            return {'error': 'Authenticate first'}
+
+        with state['lock']:
+            state['received'] += 1
+            frame_number = state['received']
+            if state['busy']:
+                # Only the newest frame waits, anything older is stale
+                if state['pending'] is not None:
+                    state['dropped'] += 1
+                state['pending'] = (frame_number, data)
+                return
+            state['busy'] = True
+
+        socketio.start_background_task(process_frames, request.sid, state, frame_number, data)
+
+    def process_frames(sid, state, frame_number, data):
+        while data is not None:
+            started = time.perf_counter()
+            try:
+                img_array, decode_factor = frame_pipeline.decode_image(data)
+                if img_array is None or img_array.size == 0:
+                    socketio.emit('frame_error', {'frame': frame_number, 'error': 'Invalid image data'}, to=sid, namespace=STREAM_NAMESPACE)
+                else:
+                    # Re-evaluated per frame so the stream downgrades while the pool is busy
+                    detector_backend = frame_pipeline.resolve_detector(state['detector_backend'], state['latency_budget_ms'])
+                    emotions, scale_x, scale_y = frame_pipeline.analyze_frame(img_array, detector_backend, encode_faces=False, tracker=state['tracker'], session_id=state['session_id'])
+                    FRAMES_TOTAL.inc(source='stream')
+                    if emotions:
+                        frame_pipeline.save(state['session_id'], state['student_id'], emotions)
+                    state['processed'] += 1
+                    socketio.emit('result', compact_result(frame_number, emotions, scale_x * decode_factor, scale_y * decode_factor, started), to=sid, namespace=STREAM_NAMESPACE)
+            except InferencePoolFull as e:
+                socketio.emit('busy', {'frame': frame_number, 'retry_after': e.retry_after}, to=sid, namespace=STREAM_NAMESPACE)
+            except Exception as e:
+                print(f"Error in stream frame: {str(e)}")
+                socketio.emit('frame_error', {'frame': frame_number, 'error': str(e)}, to=sid, namespace=STREAM_NAMESPACE)
+
+            with state['lock']:
+                if state['pending'] is None:
+                    state['busy'] = False
+                    data = None
+                else:
+                    frame_number, data = state['pending']
+                    state['pending'] = None
+
+    @socketio.on('stats', namespace=STREAM_NAMESPACE)
+    def stats():
+        state = connections.get(request.sid)
+        if state is None:
+            return {'error': 'Authenticate first'}
+        return {key: state[key] for key in ('session_id', 'received', 'processed', 'dropped')}
+
+    @socketio.on('disconnect', namespace=STREAM_NAMESPACE)
+    def disconnect(*args):
+        connections.pop(request.sid, None)
@@ -9,9 +9,10 @@ from bson.objectid import ObjectId
 import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from user_utils import identify_users, identify_user, save_emotions_to_user, token_required, is_self, is_professor
+from user_utils import identify_users, identify_user, save_emotions_to_user, token_required, is_self, is_professor, user_cache, PUBLIC_USER_PROJECTION
+from face_index import EMBEDDINGS_FIELD, EMBEDDING_VERSION
 
-def create_user_blueprint(db, config):
+def create_user_blueprint(db, config, face_index):
     users_collection = db['users']
     students_collection = db['students']  # Nueva colección para estudiantes
     user_blueprint = Blueprint('user', __name__)
@@ -47,8 +48,22 @@ def create_user_blueprint(db, config):
             user_images.append(image_path)
 
         user_data['images'] = user_images
+        # Embed the gallery images now, so identification in class only reads them
+        embeddings = face_index.compute_embeddings(user_images)
+        if not embeddings:
+            # Such a user could never be identified
+            for image_path in user_images:
+                os.remove(image_path)
+            return None
+        user_data[EMBEDDINGS_FIELD] = embeddings
+        user_data['embedding_model'] = face_index.model_name
+        user_data['embedding_version'] = EMBEDDING_VERSION
+        user_data['embeddings_updated_at'] = datetime.datetime.utcnow()
         result = users_collection.insert_one(user_data)
         user_id = result.inserted_id
+
+        # Add the new faces to the resident gallery without a rebuild
+        face_index.add_user(user_id, user_data['role'], user_data['gender'], embeddings)
         return user_id
 
     @user_blueprint.route('/register', methods=['POST'])
@@ -119,6 +134,9 @@ def create_user_blueprint(db, config):
 
             # Register the user
             user_id = register_user(images, user_data)
+            if user_id is None:
+                return jsonify({"error": "No face found in the uploaded images"}), 400
+            user_cache.invalidate(str(user_id))
             token = jwt.encode({
                     'user_id': str(user_id),
                     'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)
@@ -164,7 +182,7 @@ def create_user_blueprint(db, config):
             image_array = np.array(image)
 
             # Attempt to identify the users using the provided image
-            identified_users = identify_users(image_array, users_collection)
+            identified_users = identify_users(image_array, face_index, users_collection)
             for user in identified_users:
                 print(user['name'])
             if identified_users:
@@ -189,7 +207,7 @@ def create_user_blueprint(db, config):
             image_array = np.array(image)
 
             # Attempt to identify the users using the provided image
-            identified_user = identify_user(image_array, users_collection)
+            identified_user = identify_user(image_array, face_index, users_collection)
 
             if identified_user:
                 return jsonify({"message": "User identified successfully", "user": identified_user}), 200
@@ -204,8 +222,13 @@ def create_user_blueprint(db, config):
         if not current_user:
             return jsonify({"error": "User not found!"}), 404
         
-        current_user['_id'] = str(current_user['_id'])
-        return jsonify(current_user), 200
+        # The authenticated user is a cached projection, load the full profile
+        user = users_collection.find_one({"_id": current_user['_id']}, PUBLIC_USER_PROJECTION)
+        if not user:
+            return jsonify({"error": "User not found!"}), 404
+        
+        user['_id'] = str(user['_id'])
+        return jsonify(user), 200
     
     @user_blueprint.route('/update_profile', methods=['PUT'])
     @token_required(db, SECRET_KEY)
@@ -217,14 +240,21 @@ def create_user_blueprint(db, config):
             update_data['password'] = generate_password_hash(update_data['password'])
         
         users_collection.update_one({"_id": ObjectId(current_user['_id'])}, {"$set": update_data})
+        user_cache.invalidate(str(current_user['_id']))
         return jsonify({"message": "Profile updated successfully!"}), 200
     
     @user_blueprint.route('/students', methods=['GET'])
     @token_required(db, SECRET_KEY)
     def get_students(current_user):
-        students = list(users_collection.find({"role": "student"}))
+        students = list(users_collection.find({"role": "student"}, PUBLIC_USER_PROJECTION))
         for student in students:
             student['_id'] = str(student['_id'])
         return jsonify(students), 200
     
+    @user_blueprint.route('/cache_stats', methods=['GET'])
+    @token_required(db, SECRET_KEY)
+    @is_professor
+    def get_cache_stats(current_user):
+        return jsonify(user_cache.stats()), 200
+    
     return user_blueprint
\ No newline at end of file
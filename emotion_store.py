@@ -0,0 +1,321 @@
+import datetime
+import time
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import CollectionInvalid
+
+EMOTION_TYPES = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def ensure_emotion_events(db):
+    # Detections live in their own time-series collection instead of an
+    # ever-growing array inside the session document
+    if 'emotion_events' not in db.list_collection_names():
+        try:
+            db.create_collection('emotion_events', timeseries={
+                'timeField': 'timestamp',
+                'metaField': 'meta',
+                'granularity': 'seconds'
+            })
+        except CollectionInvalid:
+            # Another worker created it first
+            pass
+
+    events_collection = db['emotion_events']
+    events_collection.create_index([('meta.session_id', 1), ('meta.student_id', 1), ('timestamp', 1)])
+    events_collection.create_index([('meta.session_id', 1), ('timestamp', 1)])
+    return events_collection
+
+
+def ensure_emotion_counters(db):
+    # Running per-session counts, one document per student and time bucket
+    counters_collection = db['session_emotion_counters']
+    counters_collection.create_index([('session_id', 1), ('student_id', 1), ('bucket', 1)], unique=True)
+    return counters_collection
+
+
+def bucket_start(timestamp, bucket_seconds):
+    seconds = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + datetime.timedelta(seconds=seconds - seconds % bucket_seconds)
+
+
+def build_emotion_event(session_id, student_id, emotion, confidence, timestamp, identified_user_id=None, identified=False):
+    return {
+        'timestamp': timestamp,
+        'meta': {'session_id': ObjectId(session_id), 'student_id': student_id},
+        'emotion': emotion,
+        'confidence': confidence,
+        'identified': identified or identified_user_id is not None,
+        'identified_user_id': identified_user_id
+    }
+
+
+def save_frame_emotions(events_collection, counters_collection, session_id, student_id, emotions, bucket_seconds, record_write=None):
+    # Persist everything detected in one frame with a single insert and bump
+    # the session counters with a single bulk write. record_write(name, seconds)
+    # is told how long each write took.
+    return save_emotion_batch(
+        events_collection,
+        counters_collection,
+        session_id,
+        student_id,
+        [(datetime.datetime.utcnow(), emotions)],
+        bucket_seconds,
+        record_write
+    )
+
+
+def save_emotion_batch(events_collection, counters_collection, session_id, student_id, frames, bucket_seconds, record_write=None):
+    # Same as save_frame_emotions for many (timestamp, emotions) frames at once,
+    # e.g. from a recorded video: one insert and one counter upsert per bucket
+    events = []
+    increments_by_bucket = {}
+
+    for timestamp, emotions in frames:
+        for emotion in emotions:
+            identified_user = emotion.get('identified_user')
+            events.append(build_emotion_event(
+                session_id,
+                student_id,
+                emotion['dominant_emotion'],
+                emotion['emotion_confidence'],
+                timestamp,
+                identified_user_id=ObjectId(identified_user['_id']) if identified_user else None
+            ))
+            increments = increments_by_bucket.setdefault(bucket_start(timestamp, bucket_seconds), {'total': 0})
+            key = f"counts.{emotion['dominant_emotion'].lower()}"
+            increments[key] = increments.get(key, 0) + 1
+            increments['total'] += 1
+
+    if not events:
+        return None
+
+    started = time.perf_counter()
+    result = events_collection.insert_many(events, ordered=False)
+    if record_write:
+        record_write('mongo_insert_events', time.perf_counter() - started)
+    if student_id:
+        started = time.perf_counter()
+        counters_collection.bulk_write([
+            UpdateOne(
+                {
+                    'session_id': ObjectId(session_id),
+                    'student_id': student_id,
+                    'bucket': bucket
+                },
+                {'$inc': increments},
+                upsert=True
+            )
+            for bucket, increments in increments_by_bucket.items()
+        ], ordered=False)
+        if record_write:
+            record_write('mongo_update_counters', time.perf_counter() - started)
+    return result
+
+
+def session_stats(events_collection, session_id):
+    # Split every student's detections at their midpoint in time and count each
+    # emotion before and after it, all inside the database
+    pipeline = [
+        {'$match': {
+            'meta.session_id': ObjectId(session_id),
+            'meta.student_id': {'$nin': [None, '']},
+            'emotion': {'$type': 'string'}
+        }},
+        {'$setWindowFields': {
+            'partitionBy': '$meta.student_id',
+            'sortBy': {'timestamp': 1},
+            'output': {
+                'position': {'$documentNumber': {}},
+                'total': {'$count': {}, 'window': {'documents': ['unbounded', 'unbounded']}}
+            }
+        }},
+        {'$group': {
+            '_id': {
+                'student_id': '$meta.student_id',
+                'after': {'$gt': ['$position', {'$floor': {'$divide': ['$total', 2]}}]},
+                'emotion': {'$toLower': '$emotion'}
+            },
+            'count': {'$sum': 1},
+            'total': {'$first': '$total'}
+        }}
+    ]
+
+    stats_by_student = {}
+    for row in events_collection.aggregate(pipeline):
+        student_id = row['_id']['student_id']
+        if student_id not in stats_by_student:
+            stats_by_student[student_id] = {
+                'student_id': student_id,
+                'before': {emotion: 0 for emotion in EMOTION_TYPES},
+                'after': {emotion: 0 for emotion in EMOTION_TYPES},
+                'total_frames': row['total']
+            }
+        emotion = row['_id']['emotion']
+        if emotion in EMOTION_TYPES:
+            half = 'after' if row['_id']['after'] else 'before'
+            stats_by_student[student_id][half][emotion] += row['count']
+
+    return [stats_by_student[student_id] for student_id in sorted(stats_by_student)]
+
+
+def split_bucket(counts, take):
+    # Move `take` detections of a bucket to the first half, spreading them over
+    # the emotions in proportion to their counts (largest remainder first)
+    total = sum(counts.values())
+    if take <= 0 or total == 0:
+        return {emotion: 0 for emotion in counts}
+    shares = {emotion: count * take / total for emotion, count in counts.items()}
+    taken = {emotion: int(share) for emotion, share in shares.items()}
+    leftover = take - sum(taken.values())
+    for emotion in sorted(shares, key=lambda e: shares[e] - taken[e], reverse=True)[:leftover]:
+        taken[emotion] += 1
+    return taken
+
+
+def session_stats_from_counters(counters_collection, session_id):
+    # Before/after split rebuilt from the time buckets in O(students x buckets).
+    # Detections inside the bucket holding a student's midpoint are split in
+    # proportion, so the split is exact up to the bucket size.
+    buckets_by_student = {}
+    cursor = counters_collection.find(
+        {'session_id': ObjectId(session_id)},
+        {'_id': 0, 'student_id': 1, 'bucket': 1, 'counts': 1, 'total': 1}
+    ).sort([('student_id', 1), ('bucket', 1)])
+    for bucket in cursor:
+        buckets_by_student.setdefault(bucket['student_id'], []).append(bucket)
+
+    final_stats = []
+    for student_id, buckets in buckets_by_student.items():
+        total = sum(bucket.get('total', 0) for bucket in buckets)
+        if not total:
+            continue
+        mid_point = total // 2
+        before = {emotion: 0 for emotion in EMOTION_TYPES}
+        after = {emotion: 0 for emotion in EMOTION_TYPES}
+
+        seen = 0
+        for bucket in buckets:
+            counts = {emotion: count for emotion, count in bucket.get('counts', {}).items() if emotion in EMOTION_TYPES}
+            taken = split_bucket(counts, min(mid_point - seen, sum(counts.values())))
+            for emotion, count in counts.items():
+                before[emotion] += taken[emotion]
+                after[emotion] += count - taken[emotion]
+            seen += bucket.get('total', 0)
+
+        final_stats.append({
+            'student_id': student_id,
+            'before': before,
+            'after': after,
+            'total_frames': total
+        })
+
+    return final_stats
+
+
+def rebuild_session_counters(events_collection, counters_collection, session_id, bucket_seconds):
+    # Recompute the counters of a session from its stored events
+    pipeline = [
+        {'$match': {
+            'meta.session_id': ObjectId(session_id),
+            'meta.student_id': {'$nin': [None, '']},
+            'emotion': {'$type': 'string'}
+        }},
+        {'$group': {
+            '_id': {
+                'student_id': '$meta.student_id',
+                'bucket': {'$dateTrunc': {'date': '$timestamp', 'unit': 'second', 'binSize': bucket_seconds}},
+                'emotion': {'$toLower': '$emotion'}
+            },
+            'count': {'$sum': 1}
+        }}
+    ]
+
+    counters = {}
+    for row in events_collection.aggregate(pipeline):
+        key = (row['_id']['student_id'], row['_id']['bucket'])
+        counter = counters.setdefault(key, {'counts': {}, 'total': 0})
+        counter['counts'][row['_id']['emotion']] = row['count']
+        counter['total'] += row['count']
+
+    counters_collection.delete_many({'session_id': ObjectId(session_id)})
+    if counters:
+        counters_collection.insert_many([
+            {
+                'session_id': ObjectId(session_id),
+                'student_id': student_id,
+                'bucket': bucket,
+                'counts': counter['counts'],
+                'total': counter['total']
+            }
+            for (student_id, bucket), counter in counters.items()
+        ], ordered=False)
+    return len(counters)
+
+
+def session_timeline(events_collection, session_id, interval_seconds, max_points, student_id=None):
+    # Per-student and whole-class emotion counts per time bin, binned with
+    # NumPy over the session's events and merged into coarser bins when there
+    # would be more than max_points of them
+    query = {'meta.session_id': ObjectId(session_id)}
+    if student_id:
+        query['meta.student_id'] = student_id
+    cursor = events_collection.find(query, {'_id': 0, 'timestamp': 1, 'meta.student_id': 1, 'emotion': 1}).batch_size(10000)
+
+    timestamps = []
+    students = []
+    emotions = []
+    for event in cursor:
+        timestamps.append(event['timestamp'])
+        students.append(str(event.get('meta', {}).get('student_id')))
+        emotions.append(str(event.get('emotion', '')).lower())
+
+    timeline = {
+        'start': None,
+        'interval_seconds': interval_seconds,
+        'points': 0,
+        'emotion_types': EMOTION_TYPES,
+        'class': {emotion: [] for emotion in EMOTION_TYPES},
+        'students': {}
+    }
+    if not timestamps:
+        return timeline
+
+    # Map emotion labels to columns and drop anything unknown
+    labels, emotion_codes = np.unique(np.array(emotions), return_inverse=True)
+    label_columns = np.array([EMOTION_TYPES.index(label) if label in EMOTION_TYPES else -1 for label in labels])
+    emotion_codes = label_columns[emotion_codes]
+    known = emotion_codes >= 0
+
+    milliseconds = np.array(timestamps, dtype='datetime64[ms]').astype(np.int64)[known]
+    emotion_codes = emotion_codes[known]
+    student_ids, student_codes = np.unique(np.array(students)[known], return_inverse=True)
+    if milliseconds.size == 0:
+        return timeline
+
+    start = milliseconds.min()
+    bins = (milliseconds - start) // (interval_seconds * 1000)
+    points = int(bins.max()) + 1
+    if points > max_points:
+        factor = -(-points // max_points)
+        bins //= factor
+        points = -(-points // factor)
+        interval_seconds *= factor
+
+    emotion_count = len(EMOTION_TYPES)
+    flat = (student_codes * points + bins) * emotion_count + emotion_codes
+    counts = np.bincount(flat, minlength=len(student_ids) * points * emotion_count)
+    counts = counts.reshape(len(student_ids), points, emotion_count)
+    class_counts = counts.sum(axis=0)
+
+    timeline['start'] = np.datetime64(int(start), 'ms').astype(datetime.datetime).isoformat()
+    timeline['interval_seconds'] = interval_seconds
+    timeline['points'] = points
+    timeline['class'] = {emotion: class_counts[:, i].tolist() for i, emotion in enumerate(EMOTION_TYPES)}
+    timeline['students'] = {
+        student: {emotion: counts[row, :, i].tolist() for i, emotion in enumerate(EMOTION_TYPES)}
+        for row, student in enumerate(student_ids.tolist())
+    }
+    return timeline
@@ -0,0 +1,470 @@
+import datetime
+import hashlib
+import threading
+import time
+import numpy as np
+from bson.objectid import ObjectId
+from deepface import DeepFace
+from deepface.models.FacialRecognition import Model as KerasModel
+from deepface.modules import preprocessing
+from deepface.modules.verification import find_threshold
+from gallery_store import acquire_build_lock, ivf_search, open_gallery, read_sidecar, release_build_lock, write_gallery
+
+# User field holding the gallery embeddings computed at registration, as
+# [{'image_path': ..., 'embedding': [...]}], next to the 'embedding_model' they came from
+# and the time they were stored ('embeddings_updated_at')
+EMBEDDINGS_FIELD = 'face_embeddings'
+# Stored as 'embedding_version'; bumped whenever the faces are prepared
+# differently, so embeddings stored before are recomputed by reembed_faces.py
+EMBEDDING_VERSION = 2
+# How long a server process may take to re-embed a user it claimed before
+# another one retries it
+REEMBED_CLAIM_SECONDS = 600
+
+
+def normalize_rows(matrix):
+    # L2-normalize each row so a dot product is the cosine similarity
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[np.newaxis, :]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class FaceIndex:
+    # Resident gallery of enrolled faces, one float32 embedding matrix per
+    # (role, gender) partition, so identification never touches the disk.
+    # With a gallery_dir the matrices are memory-mapped gallery files shared by
+    # every process, and large ones are searched through an IVF index that
+    # scans only the nprobe lists closest to each face. Every refresh_seconds a
+    # loaded partition is checked against its users; an outdated one keeps
+    # being served while its replacement is built or mapped in the background.
+
+    def __init__(self, users_collection, model_name='VGG-Face', detector_backend='opencv', threshold=None,
+                 gallery_dir=None, nprobe=8, ivf_min_rows=4096, ivf_lists=0, refresh_seconds=30):
+        self.users_collection = users_collection
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.threshold = threshold if threshold is not None else find_threshold(model_name, 'cosine')
+        self.gallery_dir = gallery_dir
+        self.nprobe = nprobe
+        self.ivf_min_rows = ivf_min_rows
+        self.ivf_lists = ivf_lists
+        self.refresh_seconds = refresh_seconds
+        self._partitions = {}
+        self._lock = threading.Lock()
+        # Per partition: a lock held during its first load, when it was last
+        # checked, and the users added while it is refreshed in the background
+        self._load_locks = {}
+        self._checked_at = {}
+        self._rebuilding = {}
+
+    def face_crops(self, img, detector_backend=None):
+        # Unaligned BGR crops of the faces in an image, largest first. These are
+        # the same kind of crops the frame pipeline cuts from live frames, so
+        # gallery and live embeddings come from identically prepared faces.
+        face_objs = DeepFace.extract_faces(
+            img_path=img,
+            detector_backend=detector_backend or self.detector_backend,
+            enforce_detection=False,
+            align=False,
+            color_face='bgr',
+            normalize_face=False
+        )
+        face_objs = sorted(face_objs, key=lambda face_obj: face_obj['facial_area']['w'] * face_obj['facial_area']['h'], reverse=True)
+        return [face_obj['face'] for face_obj in face_objs if face_obj['face'].size > 0]
+
+    def embed_image(self, img, detector_backend=None):
+        # Return the embedding of the most prominent face in the image, or None
+        crops = self.face_crops(img, detector_backend)
+        if not crops:
+            return None
+        return self.embed_crops(crops[:1])[0]
+
+    def embed_faces(self, img, detector_backend=None):
+        # Return the embeddings of every face found in the image as an (N, D) matrix
+        crops = self.face_crops(img, detector_backend)
+        if not crops:
+            return None
+        return self.embed_crops(crops)
+
+    def embed_crops(self, crops):
+        # Embed face crops (BGR arrays) in a single forward pass, scaled to [0, 1]
+        # the way DeepFace.represent feeds the recognition models
+        model = DeepFace.build_model(model_name=self.model_name)
+        target_size = (model.input_shape[1], model.input_shape[0])
+        batch = np.concatenate([
+            preprocessing.resize_image(img=crop.astype(np.float32) / 255.0, target_size=target_size)
+            for crop in crops
+        ])
+        batch = preprocessing.normalize_input(img=batch)
+
+        # Keras networks (VGG-Face included, whose forward only adds an l2 norm
+        # that normalize_rows applies anyway) run the whole batch at once; the
+        # others (Dlib, SFace) only expose a per-image forward
+        if isinstance(model.model, KerasModel):
+            embeddings = model.model(batch, training=False).numpy()
+        else:
+            embeddings = [model.forward(batch[i:i + 1]) for i in range(len(batch))]
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def compute_embeddings(self, image_paths):
+        # Embeddings of a user's gallery images, in the form stored on the user
+        entries = []
+        for image_path in image_paths:
+            try:
+                embedding = self.embed_image(image_path)
+            except Exception as e:
+                print(f"Error embedding gallery image {image_path}: {e}")
+                continue
+            if embedding is not None:
+                entries.append({'image_path': image_path, 'embedding': embedding.tolist()})
+        return entries
+
+    def store_embeddings(self, user_id, image_paths):
+        # Compute and persist a user's embeddings with the current model. A user
+        # without any face found is left as is, so they stay outdated and are
+        # tried again instead of being stored as up to date with no faces.
+        entries = self.compute_embeddings(image_paths)
+        if not entries:
+            return entries
+        self.users_collection.update_one(
+            {'_id': user_id},
+            {'$set': {
+                EMBEDDINGS_FIELD: entries,
+                'embedding_model': self.model_name,
+                'embedding_version': EMBEDDING_VERSION,
+                'embeddings_updated_at': datetime.datetime.utcnow()
+            }}
+        )
+        return entries
+
+    def outdated_query(self):
+        # Users whose stored embeddings are missing or don't come from the
+        # current model and face preparation
+        return {'$or': [
+            {'embedding_model': {'$ne': self.model_name}},
+            {'embedding_version': {'$ne': EMBEDDING_VERSION}},
+            {EMBEDDINGS_FIELD: {'$exists': False}}
+        ]}
+
+    def reembed_outdated(self):
+        # Embed the users whose stored embeddings are outdated, e.g. after an
+        # upgrade, and add them to the loaded partitions. Each user is claimed
+        # first, so server processes starting together share the work.
+        outdated = {'$and': [self.outdated_query(), {'images.0': {'$exists': True}}]}
+        user_ids = [user['_id'] for user in self.users_collection.find(outdated, {'_id': 1})]
+        reembedded = 0
+        for user_id in user_ids:
+            now = datetime.datetime.utcnow()
+            unclaimed = {'$or': [
+                {'reembed_claimed_at': {'$exists': False}},
+                {'reembed_claimed_at': {'$lt': now - datetime.timedelta(seconds=REEMBED_CLAIM_SECONDS)}}
+            ]}
+            user = self.users_collection.find_one_and_update(
+                {'$and': [{'_id': user_id}, outdated, unclaimed]},
+                {'$set': {'reembed_claimed_at': now}},
+                projection={'images': 1, 'role': 1, 'gender': 1}
+            )
+            if user is None:
+                continue
+            entries = self.store_embeddings(user_id, user['images'])
+            if entries:
+                self.add_user(user_id, user.get('role'), user.get('gender'), entries)
+                reembedded += 1
+        if user_ids:
+            print(f"Re-embedded {reembedded} of {len(user_ids)} users with outdated face embeddings")
+        return reembedded
+
+    def reembed_outdated_in_background(self):
+        # Off the request path: until it is done, outdated users can't be identified
+        threading.Thread(target=self.reembed_outdated, name='face-reembed', daemon=True).start()
+
+    def _embeddings_partition(self, role, gender):
+        # Only stored embeddings are read: embedding users here would stall a
+        # live class, so outdated ones are left out until reembed_faces.py runs
+        embeddings = []
+        user_ids = []
+        image_paths = []
+        skipped = 0
+        projection = {EMBEDDINGS_FIELD: 1, 'embedding_model': 1, 'embedding_version': 1}
+        for user in self.users_collection.find({'role': role, 'gender': gender}, projection):
+            if user.get('embedding_model') != self.model_name or user.get('embedding_version') != EMBEDDING_VERSION or EMBEDDINGS_FIELD not in user:
+                skipped += 1
+                continue
+            for entry in user[EMBEDDINGS_FIELD]:
+                embeddings.append(entry['embedding'])
+                user_ids.append(user['_id'])
+                image_paths.append(entry['image_path'])
+        if skipped:
+            print(f"Warning: {skipped} {role}/{gender} users have no current {self.model_name} embeddings and can't be identified until they are re-embedded in the background or by reembed_faces.py")
+
+        matrix = normalize_rows(embeddings) if embeddings else None
+        return {'matrix': matrix, 'user_ids': user_ids, 'image_paths': image_paths}
+
+    def partition_version(self, role, gender):
+        # Fingerprint of the partition's users and of when their embeddings were
+        # stored, so a deletion plus a registration changes it too
+        digest = hashlib.sha1(self.model_name.encode())
+        projection = {'embedding_model': 1, 'embedding_version': 1, 'embeddings_updated_at': 1}
+        for user in self.users_collection.find({'role': role, 'gender': gender}, projection).sort('_id', 1):
+            digest.update(f"{user['_id']}:{user.get('embedding_model')}:{user.get('embedding_version')}:{user.get('embeddings_updated_at')}\n".encode())
+        return digest.hexdigest()
+
+    def build_gallery(self, role, gender):
+        # Write the partition's gallery file from the stored embeddings. The
+        # version is taken first, so a registration during the build makes the
+        # file outdated.
+        version = self.partition_version(role, gender)
+        partition = self._embeddings_partition(role, gender)
+        if partition['matrix'] is None:
+            return None
+        return write_gallery(
+            self.gallery_dir, role, gender, self.model_name,
+            partition['matrix'], partition['user_ids'], partition['image_paths'],
+            version, ivf_min_rows=self.ivf_min_rows, lists=self.ivf_lists
+        )
+
+    def _open_partition(self, sidecar):
+        matrix, centroids, offsets = open_gallery(self.gallery_dir, sidecar)
+        return {
+            'matrix': matrix,
+            'user_ids': [ObjectId(user_id) if ObjectId.is_valid(user_id) else user_id for user_id in sidecar['user_ids']],
+            'image_paths': sidecar['image_paths'],
+            'centroids': centroids,
+            'offsets': offsets,
+            'build': sidecar['build'],
+            'version': sidecar.get('version')
+        }
+
+    def _build_partition(self, role, gender):
+        sidecar = self.build_gallery(role, gender)
+        if sidecar is None:
+            return {'matrix': None, 'user_ids': [], 'image_paths': [], 'version': self.partition_version(role, gender)}
+        return self._open_partition(sidecar)
+
+    def _load_partition(self, role, gender):
+        if not self.gallery_dir:
+            version = self.partition_version(role, gender)
+            return dict(self._embeddings_partition(role, gender), version=version)
+
+        # A file from another model is useless and is rebuilt right away
+        sidecar = read_sidecar(self.gallery_dir, role, gender)
+        if sidecar is None or sidecar['model'] != self.model_name:
+            return self._build_partition(role, gender)
+        try:
+            partition = self._open_partition(sidecar)
+        except FileNotFoundError:
+            # The build was replaced and removed meanwhile
+            return self._build_partition(role, gender)
+
+        # An outdated one is served until its replacement is ready
+        if sidecar.get('version') != self.partition_version(role, gender):
+            self._refresh_in_background(role, gender)
+        return partition
+
+    def _current_partition(self, role, gender):
+        # A new mapping of the partition, or None when the loaded one is current
+        loaded = self._partitions.get((role, gender))
+        version = self.partition_version(role, gender)
+        if not self.gallery_dir:
+            if loaded is not None and loaded.get('version') == version:
+                return None
+            return dict(self._embeddings_partition(role, gender), version=version)
+
+        sidecar = read_sidecar(self.gallery_dir, role, gender)
+        if sidecar is not None and sidecar['model'] == self.model_name and sidecar.get('version') == version:
+            if loaded is not None and loaded.get('build') == sidecar['build']:
+                return None
+            try:
+                # Built by another process
+                return self._open_partition(sidecar)
+            except FileNotFoundError:
+                pass
+        if loaded is not None and loaded.get('version') == version:
+            return None
+
+        # One process rebuilds the file, the others map it on a later check
+        build_lock = acquire_build_lock(self.gallery_dir, role, gender)
+        if build_lock is None:
+            return None
+        try:
+            return self._build_partition(role, gender)
+        finally:
+            release_build_lock(build_lock)
+
+    def _refresh_in_background(self, role, gender):
+        key = (role, gender)
+        with self._lock:
+            self._checked_at[key] = time.monotonic()
+            if key in self._rebuilding:
+                return
+            self._rebuilding[key] = []
+        threading.Thread(target=self._refresh, args=(role, gender), name=f'gallery-{role}-{gender}', daemon=True).start()
+
+    def _refresh(self, role, gender):
+        key = (role, gender)
+        try:
+            partition = self._current_partition(role, gender)
+        except Exception as e:
+            print(f"Error refreshing gallery {role}/{gender}: {e}")
+            partition = None
+
+        with self._lock:
+            added = self._rebuilding.pop(key, [])
+            if partition is None:
+                return
+            # Users added during the refresh that it didn't read yet stay searchable
+            known = set(partition['user_ids'])
+            for user_id, rows, entries in added:
+                if user_id not in known:
+                    partition = self._with_rows(partition, user_id, rows, entries)
+            self._partitions[key] = partition
+        print(f"Refreshed gallery {role}/{gender}: {len(partition['user_ids'])} rows")
+
+    def get_partition(self, role, gender):
+        key = (role, gender)
+        partition = self._partitions.get(key)
+        if partition is None:
+            # Only callers of this partition wait for its first load
+            with self._lock:
+                load_lock = self._load_locks.setdefault(key, threading.Lock())
+            with load_lock:
+                partition = self._partitions.get(key)
+                if partition is None:
+                    partition = self._load_partition(role, gender)
+                    with self._lock:
+                        # A background refresh may have finished first
+                        partition = self._partitions.setdefault(key, partition)
+                        self._checked_at[key] = time.monotonic()
+        elif self.refresh_seconds and self.users_collection is not None and time.monotonic() - self._checked_at.get(key, 0) > self.refresh_seconds:
+            # Picks up users registered through other processes
+            self._refresh_in_background(role, gender)
+        return partition
+
+    def partition_keys(self):
+        keys = set(self._partitions.keys())
+        groups = self.users_collection.aggregate([
+            {'$group': {'_id': {'role': '$role', 'gender': '$gender'}}}
+        ])
+        for group in groups:
+            if group['_id'].get('role') and group['_id'].get('gender'):
+                keys.add((group['_id']['role'], group['_id']['gender']))
+        return keys
+
+    def _with_rows(self, partition, user_id, rows, entries):
+        # The partition with a user's rows added to a small in-memory block
+        # searched next to the (possibly memory-mapped) matrix, which stays
+        # untouched. Readers keep using the old snapshot until the new one is
+        # swapped in.
+        if partition['matrix'] is None:
+            return {'matrix': rows, 'user_ids': [user_id] * len(rows), 'image_paths': [entry['image_path'] for entry in entries]}
+        extra = rows if partition.get('extra') is None else np.vstack([partition['extra'], rows])
+        return dict(
+            partition,
+            extra=extra,
+            user_ids=partition['user_ids'] + [user_id] * len(rows),
+            image_paths=partition['image_paths'] + [entry['image_path'] for entry in entries]
+        )
+
+    def add_user(self, user_id, role, gender, entries):
+        # Add the new user's stored embeddings to an already loaded partition.
+        # Partitions that have not been loaded yet will pick the user up from the
+        # database on first use.
+        key = (role, gender)
+        if key not in self._partitions or not entries:
+            return
+
+        rows = normalize_rows([entry['embedding'] for entry in entries])
+        with self._lock:
+            self._partitions[key] = self._with_rows(self._partitions[key], user_id, rows, entries)
+            if key in self._rebuilding:
+                self._rebuilding[key].append((user_id, rows, entries))
+
+    def set_partition(self, role, gender, embeddings, user_ids, image_paths=None):
+        # Install a partition built outside the users collection, e.g. by the
+        # offline benchmark
+        matrix = normalize_rows(embeddings) if len(embeddings) else None
+        with self._lock:
+            self._partitions[(role, gender)] = {
+                'matrix': matrix,
+                'user_ids': list(user_ids),
+                'image_paths': list(image_paths or [None] * len(user_ids))
+            }
+
+    def _search(self, partition, queries, nprobe=None):
+        # Closest row of the partition and its cosine distance for each query
+        matrix = partition['matrix']
+        if partition.get('centroids') is not None:
+            best, best_distances = ivf_search(queries, matrix, partition['centroids'], partition['offsets'], nprobe or self.nprobe)
+        else:
+            distances = 1.0 - queries @ matrix.T
+            best = np.argmin(distances, axis=1)
+            best_distances = distances[np.arange(len(queries)), best]
+
+        # Rows added since the partition was loaded follow the matrix's rows
+        extra = partition.get('extra')
+        if extra is not None:
+            extra_distances = 1.0 - queries @ extra.T
+            extra_best = np.argmin(extra_distances, axis=1)
+            extra_best_distances = extra_distances[np.arange(len(queries)), extra_best]
+            closer = extra_best_distances < best_distances
+            best = np.where(closer, extra_best + len(matrix), best)
+            best_distances = np.where(closer, extra_best_distances, best_distances)
+        return best, best_distances
+
+    def match(self, embeddings, role, gender, nprobe=None):
+        # Match a batch of embeddings against one partition. Returns a list with
+        # (user_id, distance) for each row, or None when no gallery face is within
+        # the threshold. nprobe overrides the IVF lists scanned per face.
+        partition = self.get_partition(role, gender)
+        queries = normalize_rows(embeddings)
+        if partition['matrix'] is None:
+            return [None] * len(queries)
+
+        best, best_distances = self._search(partition, queries, nprobe)
+
+        matches = []
+        for index, distance in zip(best, best_distances):
+            if index >= 0 and distance <= self.threshold:
+                matches.append((partition['user_ids'][index], float(distance)))
+            else:
+                matches.append(None)
+        return matches
+
+    def match_any(self, embeddings):
+        # Match against every partition and keep the closest hit per row
+        queries = normalize_rows(embeddings)
+        matches = [None] * len(queries)
+        for role, gender in self.partition_keys():
+            for i, candidate in enumerate(self.match(queries, role, gender)):
+                if candidate and (matches[i] is None or candidate[1] < matches[i][1]):
+                    matches[i] = candidate
+        return matches
+
+
+    def rows_for_users(self, user_ids, role):
+        # Gallery rows of the given users, e.g. a classroom roster, as (matrix, user_ids)
+        wanted = set(user_ids)
+        matrices = []
+        row_user_ids = []
+        for partition_role, gender in self.partition_keys():
+            if partition_role != role:
+                continue
+            partition = self.get_partition(partition_role, gender)
+            if partition['matrix'] is None:
+                continue
+            rows = [i for i, user_id in enumerate(partition['user_ids']) if user_id in wanted]
+            if rows:
+                count = len(partition['matrix'])
+                matrix_rows = [i for i in rows if i < count]
+                extra_rows = [i - count for i in rows if i >= count]
+                if matrix_rows:
+                    matrices.append(np.asarray(partition['matrix'][matrix_rows]))
+                if extra_rows:
+                    matrices.append(partition['extra'][extra_rows])
+                row_user_ids.extend(partition['user_ids'][i] for i in matrix_rows + [count + i for i in extra_rows])
+        if not matrices:
+            return None, []
+        return np.vstack(matrices), row_user_ids
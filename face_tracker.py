@@ -0,0 +1,110 @@
+import threading
+import time
+import cv2
+
+
+def box_iou(a, b):
+    x1 = max(a['x'], b['x'])
+    y1 = max(a['y'], b['y'])
+    x2 = min(a['x'] + a['w'], b['x'] + b['w'])
+    y2 = min(a['y'] + a['h'], b['y'] + b['h'])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a['w'] * a['h'] + b['w'] * b['h'] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def shift_point(point, dx, dy):
+    # Eyes are {} when the detector found none
+    return {'x': point['x'] + dx, 'y': point['y'] + dy} if point else {}
+
+
+def create_cv_tracker():
+    # KCF ships with opencv-contrib, MIL with every OpenCV build
+    for name in ('TrackerKCF_create', 'TrackerMIL_create'):
+        factory = getattr(cv2, name, None) or getattr(getattr(cv2, 'legacy', None), name, None)
+        if factory:
+            return factory()
+    raise RuntimeError("No OpenCV tracker available")
+
+
+class FaceTracker:
+    # Follows the faces of one video stream between keyframes. The detector
+    # only runs on keyframes (or when a track is lost); in between, every face
+    # is moved by a cheap OpenCV tracker and keeps the identity found for it.
+
+    def __init__(self, keyframe_interval=10, iou_threshold=0.3):
+        self.keyframe_interval = keyframe_interval
+        self.iou_threshold = iou_threshold
+        self.tracks = []
+        self.frames_since_keyframe = 0
+        self.next_track_id = 1
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def needs_keyframe(self):
+        return not self.tracks or self.frames_since_keyframe >= self.keyframe_interval
+
+    def update(self, img_array):
+        # Move every track onto the new frame. Returns False as soon as one is
+        # lost so the caller can fall back to a keyframe.
+        self.last_used = time.monotonic()
+        height, width = img_array.shape[:2]
+        for track in self.tracks:
+            ok, (x, y, w, h) = track['tracker'].update(img_array)
+            if not ok or w <= 0 or h <= 0 or x + w <= 0 or y + h <= 0 or x >= width or y >= height:
+                return False
+            box = track['box']
+            dx = int(x) - box['x']
+            dy = int(y) - box['y']
+            track['box'] = {
+                'x': int(x),
+                'y': int(y),
+                'w': int(w),
+                'h': int(h),
+                'left_eye': shift_point(box['left_eye'], dx, dy),
+                'right_eye': shift_point(box['right_eye'], dx, dy)
+            }
+        self.frames_since_keyframe += 1
+        return True
+
+    def reset(self, img_array, emotions):
+        # Start new tracks from a keyframe's detections. Detections that overlap
+        # an existing track inherit its id and identity; the rest get None so
+        # the caller knows which faces still have to be identified.
+        self.last_used = time.monotonic()
+        previous = list(self.tracks)
+        tracks = []
+        carried = []
+        for emotion in emotions:
+            box = emotion['box']
+            best = None
+            best_iou = self.iou_threshold
+            for track in previous:
+                overlap = box_iou(box, track['box'])
+                if overlap >= best_iou:
+                    best, best_iou = track, overlap
+            if best is not None:
+                previous.remove(best)
+                track_id = best['track_id']
+                identified_user = best['identified_user']
+            else:
+                track_id = self.next_track_id
+                self.next_track_id += 1
+                identified_user = None
+
+            tracker = create_cv_tracker()
+            tracker.init(img_array, (box['x'], box['y'], box['w'], box['h']))
+            tracks.append({
+                'track_id': track_id,
+                'tracker': tracker,
+                'box': box,
+                'identified_user': identified_user
+            })
+            carried.append(identified_user)
+
+        self.tracks = tracks
+        self.frames_since_keyframe = 0
+        return carried
+
+    def set_identity(self, index, identified_user):
+        self.tracks[index]['identified_user'] = identified_user
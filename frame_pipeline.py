@@ -0,0 +1,466 @@
+import base64
+import io
+import threading
+import time
+from contextlib import contextmanager
+import cv2
+import numpy as np
+from bson.objectid import ObjectId
+from deepface import DeepFace
+from PIL import Image
+from face_tracker import FaceTracker
+from identity_cache import SessionIdentityCache
+from emotion_store import ensure_emotion_counters, ensure_emotion_events, save_frame_emotions
+from user_utils import identify_faces
+from metrics import FACES_PER_FRAME, STAGE_SECONDS
+
+
+class FramePipeline:
+    # Everything that happens to a decoded frame, shared by the HTTP and the
+    # streaming ingestion paths: preprocessing, detection and classification on
+    # the inference pool, identification and persistence.
+
+    def __init__(self, db, config, face_index, model_registry, inference_pool, emotion_batcher, detector_selector=None, inference_processes=None):
+        # Without a database (offline benchmarks) the stages run but nothing is stored
+        self.users_collection = db['users'] if db is not None else None
+        self.sessions_collection = db['sessions'] if db is not None else None
+        self.classrooms_collection = db['classrooms'] if db is not None else None
+        self.emotion_events_collection = ensure_emotion_events(db) if db is not None else None
+        self.emotion_counters_collection = ensure_emotion_counters(db) if db is not None else None
+        self.counter_bucket_seconds = config['EMOTION_COUNTER_BUCKET_SECONDS']
+        self.face_index = face_index
+        self.model_registry = model_registry
+        self.inference_pool = inference_pool
+        self.emotion_batcher = emotion_batcher
+        self.detector_selector = detector_selector
+        self.inference_processes = inference_processes
+        self.tracker_keyframe_interval = config['TRACKER_KEYFRAME_INTERVAL']
+        self.tracker_iou_threshold = config['TRACKER_IOU_THRESHOLD']
+        self.tracker_idle_seconds = config['TRACKER_IDLE_SECONDS']
+        self._trackers = {}
+        self._trackers_lock = threading.Lock()
+        self.identity_cache_size = config['IDENTITY_CACHE_SIZE']
+        self.identity_cache_idle_seconds = config['IDENTITY_CACHE_IDLE_SECONDS']
+        self._identity_caches = {}
+        self._identity_caches_lock = threading.Lock()
+        self.analysis_max_dimension = config['ANALYSIS_MAX_DIMENSION']
+        self.detection_max_dimension = config['DETECTION_MAX_DIMENSION']
+        self._stage_totals = {}
+        self._stage_lock = threading.Lock()
+
+    def record_stage(self, stage, seconds, timings=None):
+        # Feeds /emotion/stages, the /metrics histogram and the request's Server-Timing spans
+        with self._stage_lock:
+            totals = self._stage_totals.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        if timings is not None:
+            timings.add(stage, seconds)
+
+    @contextmanager
+    def stage(self, stage, timings=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - started, timings)
+
+    def stage_stats(self):
+        with self._stage_lock:
+            return {
+                stage: {'count': count, 'avg_ms': round(seconds * 1000 / count, 2)}
+                for stage, (count, seconds) in self._stage_totals.items()
+            }
+
+    def analysis_size(self, width, height, max_dimension):
+        # Size of a frame with its longest side capped, never larger than the received one
+        longest = max(width, height)
+        if not max_dimension or longest <= max_dimension:
+            return width, height
+        factor = max_dimension / longest
+        return max(int(width * factor), 1), max(int(height * factor), 1)
+
+    def decode_image(self, data, timings=None):
+        # Decode the uploaded bytes as BGR, letting libjpeg scale the image down
+        # by 2, 4 or 8 while decoding when the frame faces are cropped from is
+        # that much smaller. Returns the image and the factor back to the received size.
+        if not data:
+            return None, 1.0
+        started = time.perf_counter()
+        buffer = np.frombuffer(data, np.uint8)
+        flag = cv2.IMREAD_COLOR
+        reduction = 1
+        try:
+            # Only the header is parsed here
+            width, height = Image.open(io.BytesIO(data)).size
+            target_width, target_height = self.analysis_size(width, height, self.analysis_max_dimension)
+            for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if width // factor >= target_width and height // factor >= target_height:
+                    flag, reduction = reduced_flag, factor
+                    break
+        except Exception:
+            pass
+
+        img_array = cv2.imdecode(buffer, flag)
+        self.record_stage('decode', time.perf_counter() - started, timings)
+        if img_array is None or img_array.size == 0:
+            return None, 1.0
+        return img_array, float(reduction)
+
+    def preprocess_image(self, img_array, timings=None):
+        # Shrink to the detection size first so the filters run on fewer pixels,
+        # then filter the single grayscale buffer in place
+        started = time.perf_counter()
+        height, width = img_array.shape[:2]
+        size = self.analysis_size(width, height, self.detection_max_dimension)
+        resized_img = img_array if size == (width, height) else cv2.resize(img_array, size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(resized_img, cv2.COLOR_BGR2GRAY)
+        cv2.GaussianBlur(gray, (5, 5), 0, dst=gray)
+        cv2.equalizeHist(gray, dst=gray)
+        # The detector and classifiers expect three channels
+        preprocessed_img = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+        self.record_stage('preprocess', time.perf_counter() - started, timings)
+        # Return the preprocessed image and the original dimensions
+        return preprocessed_img, width, height
+
+    def convert_region_to_box(self, region):
+        box = {
+            'x': int(region['x']),
+            'y': int(region['y']),
+            'w': int(region['w']),
+            'h': int(region['h']),
+            # opencv and ssd return None when they find no eyes
+            'left_eye': self.convert_eye(region.get('left_eye')),
+            'right_eye': self.convert_eye(region.get('right_eye'))
+        }
+        
+        return box
+
+    def convert_eye(self, eye):
+        return {'x': int(eye[0]), 'y': int(eye[1])} if eye is not None else {}
+
+    def crop_faces(self, full_img, detection_shape, boxes):
+        # Cut the faces found on the detection frame (of detection_shape) out of
+        # the full-resolution frame, so small and distant faces keep their detail
+        scale_x = full_img.shape[1] / detection_shape[1]
+        scale_y = full_img.shape[0] / detection_shape[0]
+        crops = []
+        for box in boxes:
+            x = max(int(box['x'] * scale_x), 0)
+            y = max(int(box['y'] * scale_y), 0)
+            crops.append(full_img[y:int((box['y'] + box['h']) * scale_y), x:int((box['x'] + box['w']) * scale_x)])
+        return crops
+
+    def classify_crops(self, crops):
+        # The classifier expects RGB crops scaled to [0, 1] like DeepFace.extract_faces returns
+        return self.emotion_batcher.run([
+            crop[:, :, ::-1].astype(np.float32) / 255.0 for crop in crops
+        ])
+
+    def detect_faces(self, img_array, detector_backend='mtcnn'):
+        # Returns the boxes and the aligned RGB faces DeepFace found on the frame
+        # Make sure the detector is resident before DeepFace reaches for it
+        self.model_registry.ensure_detector(detector_backend)
+        face_objs = DeepFace.extract_faces(img_array, detector_backend=detector_backend, enforce_detection=False)
+        face_objs = [face_obj for face_obj in face_objs if face_obj['face'].shape[0] > 0 and face_obj['face'].shape[1] > 0]
+        boxes = [self.convert_region_to_box(face_obj['facial_area']) for face_obj in face_objs]
+        return boxes, [face_obj['face'] for face_obj in face_objs]
+
+    def analyze_emotion(self, img_array, detector_backend='mtcnn', encode_faces=True, full_img=None):
+        # Detect the faces on the small frame, then classify them together with
+        # the faces of concurrent requests in a single batch
+        boxes, aligned_faces = self.detect_faces(img_array, detector_backend)
+        if full_img is None:
+            results = self.emotion_batcher.run(aligned_faces)
+            crops = self.crop_faces(img_array, img_array.shape, boxes)
+        else:
+            crops = self.crop_faces(full_img, img_array.shape, boxes)
+            keep = [i for i, crop in enumerate(crops) if crop.size > 0]
+            boxes = [boxes[i] for i in keep]
+            crops = [crops[i] for i in keep]
+            results = self.classify_crops(crops)
+        return self.build_emotions(boxes, crops, results, encode_faces)
+
+    def build_emotions(self, boxes, crops, results, encode_faces=True):
+        emotions = []
+        faces = []
+        
+        for box, _face_region, result in zip(boxes, crops, results):
+            # Extract the dominant emotion and its confidence
+            dominant_emotion = result['dominant_emotion']
+            emotion_confidence = result['emotion'][dominant_emotion]
+            dominant_gender = result['dominant_gender']
+            
+            faces.append(_face_region)
+            
+            emotion = {
+                'dominant_emotion': dominant_emotion,
+                'emotion_confidence': emotion_confidence,
+                'dominant_gender': dominant_gender,
+                'box': box,
+            }
+            if encode_faces:
+                emotion['face_region'] = base64.b64encode(cv2.imencode('.jpg', _face_region)[1]).decode('utf-8')
+            
+            emotions.append(emotion)
+            
+        return emotions, faces
+
+    def track_emotion(self, img_array, detector_backend, encode_faces, tracker, session_id=None, full_img=None):
+        # Between keyframes only the emotion classifier runs: the tracker moves
+        # the boxes on the small frame and every face keeps the identity of its track
+        if full_img is None:
+            full_img = img_array
+        with tracker.lock:
+            if not tracker.needs_keyframe() and tracker.update(img_array):
+                boxes = [track['box'] for track in tracker.tracks]
+                crops = self.crop_faces(full_img, img_array.shape, boxes)
+                if all(crop.size > 0 for crop in crops):
+                    results = self.classify_crops(crops)
+                    emotions, _ = self.build_emotions(boxes, crops, results, encode_faces)
+                    for emotion, track in zip(emotions, tracker.tracks):
+                        emotion['track_id'] = track['track_id']
+                        emotion['identified_user'] = track['identified_user']
+                    return emotions
+
+            # Keyframe: full detection, identities carried over where tracks overlap
+            emotions, faces = self.analyze_emotion(img_array, detector_backend, encode_faces, full_img)
+            carried = tracker.reset(img_array, emotions)
+            unknown = [i for i, identified_user in enumerate(carried) if identified_user is None]
+            for i, identified_user in enumerate(carried):
+                emotions[i]['identified_user'] = identified_user
+                emotions[i]['track_id'] = tracker.tracks[i]['track_id']
+            if unknown:
+                self.identify([emotions[i] for i in unknown], [faces[i] for i in unknown], session_id)
+                for i in unknown:
+                    tracker.set_identity(i, emotions[i]['identified_user'])
+            return emotions
+
+    def get_tracker(self, key):
+        # One tracker per stream, dropped after it has been idle for a while
+        now = time.monotonic()
+        with self._trackers_lock:
+            for stale_key in [k for k, t in self._trackers.items() if now - t.last_used > self.tracker_idle_seconds]:
+                del self._trackers[stale_key]
+            tracker = self._trackers.get(key)
+            if tracker is None:
+                tracker = self.create_tracker()
+                self._trackers[key] = tracker
+            return tracker
+
+    def create_tracker(self):
+        return FaceTracker(keyframe_interval=self.tracker_keyframe_interval, iou_threshold=self.tracker_iou_threshold)
+
+    def draw_boxes(self, img_array, emotions, scale_x, scale_y):
+        # Draw rectangles and emotion text on the image
+        for emotion_data in emotions:
+            box = emotion_data['box']
+            x, y, w, h = box['x'], box['y'], box['w'], box['h']
+            x = int(x * scale_x)
+            y = int(y * scale_y)
+            w = int(w * scale_x)
+            h = int(h * scale_y)
+            
+            # Draw rectangle around the face
+            cv2.rectangle(img_array, (x, y), (x + w, y + h), (255, 0, 0), 2)
+            
+            # Draw points for the eyes
+            left_eye_x = box['left_eye'].get('x', 0)
+            left_eye_y = box['left_eye'].get('y', 0)
+            right_eye_x = box['right_eye'].get('x', 0)
+            right_eye_y = box['right_eye'].get('y', 0)
+            
+            
+            radius = 20
+
+            if box['left_eye']:
+                cv2.circle(img_array, (int(left_eye_x * scale_x), int(left_eye_y * scale_y)), radius, (0, 0, 255), -1)
+            if box['right_eye']:
+                cv2.circle(img_array, (int(right_eye_x * scale_x), int(right_eye_y * scale_y)), radius, (0, 0, 255), -1)
+            
+            identified_user = emotion_data['identified_user']
+            emotion_text = f"{emotion_data['dominant_emotion']}"
+            if identified_user:
+                emotion_text = f"{emotion_text} - {identified_user['name']}"
+                
+            font_scale = 4.0  # Increase this value to make the text larger
+            thickness = 2   
+            
+            # Calculate the position for the text
+            text_size, _ = cv2.getTextSize(emotion_text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+            text_w, text_h = text_size
+            text_x = x
+            text_y = y - 10 if y - 10 > 10 else y + 10
+                
+            # Draw rectangle behind the text
+            cv2.rectangle(img_array, (text_x, text_y - text_h - 5), (text_x + text_w, text_y + 40), (255, 0, 0), -1)
+
+            # Put the emotion text on the image
+            cv2.putText(img_array, emotion_text, (text_x, text_y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (255, 255, 255), thickness)
+
+    def render_annotated(self, img_array, emotions, scale_x, scale_y, max_dimension=None):
+        # Shrink the frame to max_dimension first so the boxes are drawn on, and
+        # the JPEG is encoded from, the smaller image
+        height, width = img_array.shape[:2]
+        if max_dimension and max(height, width) > max_dimension:
+            factor = max_dimension / max(height, width)
+            img_array = cv2.resize(img_array, (int(width * factor), int(height * factor)), interpolation=cv2.INTER_AREA)
+            scale_x *= factor
+            scale_y *= factor
+        self.draw_boxes(img_array, emotions, scale_x, scale_y)
+        return img_array
+
+    def encode_jpeg(self, img_array, quality=90):
+        ok, encoded = cv2.imencode('.jpg', img_array, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+        if not ok:
+            raise ValueError("Could not encode image")
+        return encoded.tobytes()
+
+    def resolve_detector(self, detector_backend, latency_budget_ms=None):
+        # 'auto' or a latency budget lets the selector pick the backend
+        if self.detector_selector is None or (detector_backend != 'auto' and not latency_budget_ms):
+            return detector_backend
+        return self.detector_selector.select(latency_budget_ms)
+
+    def session_exists(self, session_id):
+        return self.sessions_collection.find_one({'_id': ObjectId(session_id)}, {'_id': 1}) is not None
+
+    def get_identity_cache(self, session_id):
+        # Session-scoped cache seeded with the gallery rows of the classroom roster
+        now = time.monotonic()
+        with self._identity_caches_lock:
+            for stale_id in [k for k, c in self._identity_caches.items() if now - c.last_used > self.identity_cache_idle_seconds]:
+                del self._identity_caches[stale_id]
+            cache = self._identity_caches.get(session_id)
+        if cache is not None:
+            return cache
+
+        roster = []
+        session = self.sessions_collection.find_one({'_id': ObjectId(session_id)}, {'classroom_id': 1})
+        if session and session.get('classroom_id'):
+            classroom = self.classrooms_collection.find_one({'_id': ObjectId(session['classroom_id'])}, {'students': 1})
+            roster = classroom.get('students', []) if classroom else []
+        roster_matrix, roster_user_ids = self.face_index.rows_for_users(roster, 'student')
+        cache = SessionIdentityCache(
+            self.face_index.threshold,
+            roster_matrix=roster_matrix,
+            roster_user_ids=roster_user_ids,
+            max_recent=self.identity_cache_size
+        )
+        with self._identity_caches_lock:
+            return self._identity_caches.setdefault(session_id, cache)
+
+    def identity_cache_stats(self, session_id):
+        cache = self._identity_caches.get(session_id)
+        return cache.stats() if cache else None
+
+    def identify(self, emotions, faces, session_id=None, embeddings=None):
+        # Identify all detected faces of the frame in one batch
+        identity_cache = self.get_identity_cache(session_id) if session_id else None
+        genders = ["female" if emotion.get('dominant_gender') == "Woman" else "male" for emotion in emotions]
+        identified_users = identify_faces(faces, genders, self.face_index, self.users_collection, 'student', identity_cache, embeddings)
+
+        for emotion, identified_user in zip(emotions, identified_users):
+            emotion['identified_user'] = identified_user
+
+    def analyze_frame(self, img_array, detector_backend='mtcnn', encode_faces=True, tracker=None, session_id=None, timings=None):
+        # Returns the identified emotions and the factors that map their boxes
+        # back onto img_array. Raises InferencePoolFull when the pool is saturated.
+        if self.inference_processes is not None and tracker is None:
+            return self.analyze_frame_in_process(img_array, detector_backend, encode_faces, session_id, timings)
+
+        preprocessed_img, original_width, original_height = self.preprocess_image(img_array, timings)
+
+        scale_x = original_width / preprocessed_img.shape[1]
+        scale_y = original_height / preprocessed_img.shape[0]
+
+        # Run the analysis on the shared inference pool; the span includes the queue wait
+        if tracker is not None:
+            with self.stage('analyze', timings):
+                emotions = self.inference_pool.run(self.track_emotion, preprocessed_img, detector_backend, encode_faces, tracker, session_id, img_array)
+            FACES_PER_FRAME.observe(len(emotions))
+            return emotions, scale_x, scale_y
+
+        with self.stage('analyze', timings):
+            emotions, faces = self.inference_pool.run(self.analyze_emotion, preprocessed_img, detector_backend, encode_faces, img_array)
+        FACES_PER_FRAME.observe(len(emotions))
+
+        if emotions:
+            with self.stage('identify', timings):
+                self.identify(emotions, faces, session_id)
+        return emotions, scale_x, scale_y
+
+    def analyze_frame_in_process(self, img_array, detector_backend, encode_faces, session_id, timings):
+        # Preprocessing, detection, classification and embedding all run in an
+        # inference process; the pool's thread only hands the frame over
+        with self.stage('analyze', timings):
+            emotions, detection_shape, embeddings = self.inference_pool.run(
+                self.inference_processes.analyze, img_array, detector_backend, self.face_index is not None
+            )
+        FACES_PER_FRAME.observe(len(emotions))
+
+        scale_x = img_array.shape[1] / detection_shape[1]
+        scale_y = img_array.shape[0] / detection_shape[0]
+        faces = None
+        if encode_faces:
+            faces = self.crop_faces(img_array, detection_shape, [emotion['box'] for emotion in emotions])
+            for emotion, face in zip(emotions, faces):
+                emotion['face_region'] = base64.b64encode(cv2.imencode('.jpg', face)[1]).decode('utf-8')
+
+        if emotions:
+            with self.stage('identify', timings):
+                self.identify(emotions, faces, session_id, embeddings)
+        return emotions, scale_x, scale_y
+
+    def save(self, session_id, student_id, emotions, timings=None):
+        # Store the detected emotions with a single insert
+        return save_frame_emotions(
+            self.emotion_events_collection,
+            self.emotion_counters_collection,
+            session_id,
+            student_id,
+            emotions,
+            self.counter_bucket_seconds,
+            record_write=lambda name, seconds: self.record_stage(name, seconds, timings)
+        )
+
+def scale_box(box, scale_x, scale_y):
+    def scale_point(point):
+        return {'x': int(point['x'] * scale_x), 'y': int(point['y'] * scale_y)} if point else {}
+    return {
+        'x': int(box['x'] * scale_x),
+        'y': int(box['y'] * scale_y),
+        'w': int(box['w'] * scale_x),
+        'h': int(box['h'] * scale_y),
+        'left_eye': scale_point(box['left_eye']),
+        'right_eye': scale_point(box['right_eye'])
+    }
+
+def full_emotions(emotions, scale_x, scale_y):
+    # The full response's emotions with their boxes scaled from the detection
+    # frame, e.g. to the half-size frame the detector used to run on
+    return [dict(emotion, box=scale_box(emotion['box'], scale_x, scale_y)) for emotion in emotions]
+
+def compact_emotions(emotions, scale_x, scale_y, include_boxes=True):
+    # Results without any images, boxes in the coordinates of the received frame
+    results = []
+    for emotion in emotions:
+        identified_user = emotion.get('identified_user')
+        result = {
+            'emotion': emotion['dominant_emotion'],
+            'confidence': round(float(emotion['emotion_confidence']), 2),
+            'gender': emotion['dominant_gender'],
+            'track_id': emotion.get('track_id'),
+            'student_id': identified_user['_id'] if identified_user else None,
+            'name': identified_user.get('name') if identified_user else None
+        }
+        if include_boxes:
+            result['box'] = [
+                int(emotion['box']['x'] * scale_x),
+                int(emotion['box']['y'] * scale_y),
+                int(emotion['box']['w'] * scale_x),
+                int(emotion['box']['h'] * scale_y)
+            ]
+        results.append(result)
+    return results
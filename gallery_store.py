@@ -0,0 +1,178 @@
+import glob
+import json
+import os
+import time
+import uuid
+import numpy as np
+
+# On-disk gallery of one (role, gender) partition, shared read-only by every
+# server process through the page cache:
+#
+#   <role>-<gender>.<build>.f32      float32 (count, dim) matrix of L2-normalized
+#                                    embeddings, opened with np.memmap
+#   <role>-<gender>.<build>.ivf.npz  IVF centroids and list offsets (large galleries)
+#   <role>-<gender>.json             sidecar: build, model, shape and the user id
+#                                    and image path of every row
+#
+# With an IVF index the rows are stored grouped by list, so each list is one
+# contiguous slice of the file. The sidecar is replaced last, which makes a new
+# build visible atomically.
+
+# Files of older builds are removed once they are this old, so a build another
+# process is still writing is left alone
+STALE_BUILD_SECONDS = 600
+
+
+def partition_name(role, gender):
+    return f'{role}-{gender}'
+
+
+def train_centroids(matrix, lists, iterations=10, sample_per_list=64, seed=0):
+    # Spherical k-means on a sample of the rows; the centroids stay unit length
+    # so a dot product ranks lists by cosine similarity
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(matrix), lists * sample_per_list)
+    sample = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=lists)
+        # Empty lists restart from a random sample row
+        empty = counts == 0
+        sums[empty] = sample[rng.integers(len(sample), size=int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = sums / norms
+    return centroids.astype(np.float32)
+
+
+def assign_lists(matrix, centroids, chunk_rows=8192):
+    assignment = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), chunk_rows):
+        assignment[start:start + chunk_rows] = np.argmax(matrix[start:start + chunk_rows] @ centroids.T, axis=1)
+    return assignment
+
+
+def write_gallery(directory, role, gender, model_name, matrix, user_ids, image_paths, version, ivf_min_rows=4096, lists=0):
+    # matrix holds normalized rows; version fingerprints the users it was built
+    # from, used to tell when the file is out of date
+    os.makedirs(directory, exist_ok=True)
+    name = partition_name(role, gender)
+    build = uuid.uuid4().hex[:12]
+    count, dim = matrix.shape
+
+    ivf_file = None
+    if count >= ivf_min_rows:
+        lists = min(lists or max(1, int(np.sqrt(count))), count)
+        centroids = train_centroids(matrix, lists)
+        assignment = assign_lists(matrix, centroids)
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.searchsorted(assignment[order], np.arange(lists + 1))
+        ivf_file = f'{name}.{build}.ivf.npz'
+        np.savez(os.path.join(directory, ivf_file), centroids=centroids, offsets=offsets)
+    else:
+        order = np.arange(count)
+
+    matrix_file = f'{name}.{build}.f32'
+    rows = np.memmap(os.path.join(directory, matrix_file), dtype=np.float32, mode='w+', shape=(count, dim))
+    for start in range(0, count, 8192):
+        rows[start:start + 8192] = matrix[order[start:start + 8192]]
+    rows.flush()
+    del rows
+
+    sidecar = {
+        'build': build,
+        'model': model_name,
+        'count': count,
+        'dim': dim,
+        'version': version,
+        'matrix_file': matrix_file,
+        'ivf_file': ivf_file,
+        'user_ids': [str(user_ids[i]) for i in order],
+        'image_paths': [image_paths[i] for i in order]
+    }
+    sidecar_path = os.path.join(directory, f'{name}.json')
+    with open(f'{sidecar_path}.{build}.tmp', 'w') as sidecar_file:
+        json.dump(sidecar, sidecar_file)
+    os.replace(f'{sidecar_path}.{build}.tmp', sidecar_path)
+
+    # Processes that still have an earlier build mapped keep reading it
+    for path in glob.glob(os.path.join(directory, f'{name}.*.f32')) + glob.glob(os.path.join(directory, f'{name}.*.ivf.npz')):
+        if build not in os.path.basename(path) and time.time() - os.path.getmtime(path) > STALE_BUILD_SECONDS:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return sidecar
+
+
+def acquire_build_lock(directory, role, gender):
+    # Lets one process at a time rebuild a partition. Returns the lock file's
+    # path, or None when another process holds it; a lock older than
+    # STALE_BUILD_SECONDS was left by a build that crashed.
+    path = os.path.join(directory, f'{partition_name(role, gender)}.lock')
+    try:
+        if time.time() - os.path.getmtime(path) > STALE_BUILD_SECONDS:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return None
+    return path
+
+
+def release_build_lock(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_sidecar(directory, role, gender):
+    try:
+        with open(os.path.join(directory, f'{partition_name(role, gender)}.json')) as sidecar_file:
+            return json.load(sidecar_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def open_gallery(directory, sidecar):
+    # Returns (matrix, centroids, offsets); the matrix is a read-only memmap
+    matrix = None
+    if sidecar['count']:
+        matrix = np.memmap(
+            os.path.join(directory, sidecar['matrix_file']),
+            dtype=np.float32,
+            mode='r',
+            shape=(sidecar['count'], sidecar['dim'])
+        )
+    centroids = offsets = None
+    if sidecar['ivf_file']:
+        with np.load(os.path.join(directory, sidecar['ivf_file'])) as ivf:
+            centroids = ivf['centroids']
+            offsets = ivf['offsets']
+    return matrix, centroids, offsets
+
+
+def ivf_search(queries, matrix, centroids, offsets, nprobe):
+    # Best row and its cosine distance for each query, scanning only the nprobe
+    # lists closest to it. More lists raise recall and latency.
+    nprobe = min(nprobe, len(centroids))
+    probes = np.argpartition(-(queries @ centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+    best_rows = np.full(len(queries), -1, dtype=np.int64)
+    best_distances = np.full(len(queries), np.inf, dtype=np.float32)
+    for i, query in enumerate(queries):
+        for list_index in probes[i]:
+            start, end = offsets[list_index], offsets[list_index + 1]
+            if start == end:
+                continue
+            distances = 1.0 - matrix[start:end] @ query
+            row = int(np.argmin(distances))
+            if distances[row] < best_distances[i]:
+                best_rows[i] = start + row
+                best_distances[i] = distances[row]
+    return best_rows, best_distances
@@ -0,0 +1,73 @@
+import threading
+import time
+import numpy as np
+from face_index import normalize_rows
+
+
+class SessionIdentityCache:
+    # Small per-session set of embeddings already resolved to students: the
+    # classroom roster's gallery rows plus the most recent live faces that were
+    # identified. Faces are matched here first and only go to the full gallery
+    # on a miss.
+
+    def __init__(self, threshold, roster_matrix=None, roster_user_ids=None, max_recent=128):
+        self.threshold = threshold
+        self.max_recent = max_recent
+        self.roster_matrix = roster_matrix
+        self.roster_user_ids = list(roster_user_ids or [])
+        self.recent_matrix = None
+        self.recent_user_ids = []
+        self.hits = 0
+        self.misses = 0
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()
+
+    def match(self, embeddings):
+        # Returns the user id of every row that is within the threshold of a
+        # cached embedding, None for the rest
+        self.last_used = time.monotonic()
+        queries = normalize_rows(embeddings)
+        with self._lock:
+            blocks = [m for m in (self.roster_matrix, self.recent_matrix) if m is not None]
+            user_ids = self.roster_user_ids + self.recent_user_ids
+        if not blocks:
+            with self._lock:
+                self.misses += len(queries)
+            return [None] * len(queries)
+
+        distances = 1.0 - queries @ np.vstack(blocks).T
+        best = np.argmin(distances, axis=1)
+        best_distances = distances[np.arange(len(queries)), best]
+
+        matches = []
+        for index, distance in zip(best, best_distances):
+            matches.append(user_ids[index] if distance <= self.threshold else None)
+        hits = sum(1 for match in matches if match is not None)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(matches) - hits
+        return matches
+
+    def add(self, embeddings, user_ids):
+        # Remember faces the gallery resolved, keeping only the most recent ones
+        if not user_ids:
+            return
+        rows = normalize_rows(embeddings)
+        with self._lock:
+            matrix = rows if self.recent_matrix is None else np.vstack([self.recent_matrix, rows])
+            ids = self.recent_user_ids + list(user_ids)
+            self.recent_matrix = matrix[-self.max_recent:]
+            self.recent_user_ids = ids[-self.max_recent:]
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            roster, recent = len(self.roster_user_ids), len(self.recent_user_ids)
+        lookups = hits + misses
+        return {
+            'roster_embeddings': roster,
+            'recent_embeddings': recent,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,102 @@
+import concurrent.futures
+import math
+import threading
+import time
+from collections import deque
+
+
+class InferencePoolFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InferencePool:
+    # One bounded executor shared by the whole app. At most
+    # max_workers + max_queue jobs are admitted; anything beyond that is
+    # rejected immediately instead of piling up behind the models.
+
+    def __init__(self, max_workers=2, max_queue=8):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inference')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_times = deque(maxlen=200)
+        self._run_times = deque(maxlen=200)
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise InferencePoolFull(self.retry_after())
+
+        enqueued = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+
+        def job():
+            started = time.perf_counter()
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._wait_times.append(started - enqueued)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._run_times.append(time.perf_counter() - started)
+                self._slots.release()
+
+        try:
+            return self._executor.submit(job)
+        except RuntimeError:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+
+    def run(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    def retry_after(self):
+        # Seconds until the current backlog should have drained, at least one
+        with self._lock:
+            backlog = self._queued + self._running
+            run_time = sum(self._run_times) / len(self._run_times) if self._run_times else 1.0
+        return max(1, math.ceil(backlog * run_time / self.max_workers))
+
+    def pressure(self):
+        # Share of the admission slots in use, 1.0 when new jobs are rejected
+        with self._lock:
+            return (self._queued + self._running) / (self.max_workers + self.max_queue)
+
+    def expected_wait(self):
+        # Seconds a job submitted now should wait before a worker picks it up
+        with self._lock:
+            if self._running < self.max_workers:
+                return 0.0
+            run_time = sum(self._run_times) / len(self._run_times) if self._run_times else 0.0
+            return (self._queued + 1) * run_time / self.max_workers
+
+    def stats(self):
+        with self._lock:
+            wait_times = sorted(self._wait_times)
+            run_times = list(self._run_times)
+            return {
+                'workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'queued': self._queued,
+                'running': self._running,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'avg_wait_seconds': round(sum(wait_times) / len(wait_times), 4) if wait_times else 0.0,
+                'p95_wait_seconds': round(wait_times[int(0.95 * (len(wait_times) - 1))], 4) if wait_times else 0.0,
+                'avg_run_seconds': round(sum(run_times) / len(run_times), 4) if run_times else 0.0
+            }
@@ -0,0 +1,241 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class FrameJobQueue:
+    # Frames accepted for asynchronous analysis, kept in a local SQLite file so
+    # they survive a restart. Background threads take jobs in arrival order, run
+    # the handler and store its JSON result for the client to poll.
+    #
+    # Several server processes may share the file. A running job belongs to the
+    # queue that claimed it (worker_id), which renews its heartbeat_at; only
+    # jobs whose heartbeat is older than lease_seconds go back to the queue.
+
+    def __init__(self, path, max_pending=1000, retention_seconds=3600, lease_seconds=60):
+        self.path = path
+        self.max_pending = max_pending
+        self.retention_seconds = retention_seconds
+        self.lease_seconds = lease_seconds
+        self.worker_id = uuid.uuid4().hex
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                owner_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                frame BLOB,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL DEFAULT 0,
+                worker_id TEXT,
+                heartbeat_at REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        # Files created before jobs could be delayed or leased
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(jobs)')]
+        if 'available_at' not in columns:
+            self._connection.execute('ALTER TABLE jobs ADD COLUMN available_at REAL NOT NULL DEFAULT 0')
+        if 'worker_id' not in columns:
+            self._connection.execute('ALTER TABLE jobs ADD COLUMN worker_id TEXT')
+            self._connection.execute('ALTER TABLE jobs ADD COLUMN heartbeat_at REAL')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)')
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._threads = []
+        self.requeue_expired()
+
+    def requeue_expired(self):
+        # Jobs that were running in a process that stopped start over
+        with self._lock:
+            requeued = self._connection.execute(
+                "UPDATE jobs SET status = 'queued', worker_id = NULL WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (time.time() - self.lease_seconds,)
+            ).rowcount
+            self._connection.commit()
+            if requeued:
+                self._changed.notify_all()
+        return requeued
+
+    def _heartbeat(self):
+        # Renew the lease of the jobs this queue is running
+        while True:
+            try:
+                with self._lock:
+                    self._connection.execute(
+                        "UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND worker_id = ?",
+                        (time.time(), self.worker_id)
+                    )
+                    self._connection.commit()
+            except Exception as e:
+                print(f"Error renewing frame job leases: {str(e)}")
+            time.sleep(self.lease_seconds / 4)
+
+    def enqueue(self, owner_id, params, frame):
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            pending = self._connection.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs are pending")
+            self._connection.execute(
+                "INSERT INTO jobs (id, owner_id, status, params, frame, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, owner_id, json.dumps(params), sqlite3.Binary(frame), now, now)
+            )
+            self._connection.commit()
+            self._changed.notify_all()
+        return job_id
+
+    def _claim(self, timeout):
+        # Oldest queued job that is not delayed, marked as running, or None after timeout
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                row = self._connection.execute(
+                    "SELECT id, owner_id, params, frame, attempts FROM jobs WHERE status = 'queued' AND available_at <= ? ORDER BY created_at LIMIT 1",
+                    (time.time(),)
+                ).fetchone()
+                if row is not None:
+                    # Conditional update, so another process sharing the file can't take it too
+                    now = time.time()
+                    claimed = self._connection.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker_id = ?, heartbeat_at = ?, updated_at = ? WHERE id = ? AND status = 'queued'",
+                        (self.worker_id, now, now, row[0])
+                    ).rowcount
+                    self._connection.commit()
+                    if claimed:
+                        return {'id': row[0], 'owner_id': row[1], 'params': json.loads(row[2]), 'frame': bytes(row[3]), 'attempts': row[4] + 1}
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # Wake up when the next delayed job becomes available
+                next_available = self._connection.execute(
+                    "SELECT MIN(available_at) FROM jobs WHERE status = 'queued'"
+                ).fetchone()[0]
+                if next_available is not None:
+                    remaining = min(remaining, max(next_available - time.time(), 0.01))
+                self._changed.wait(remaining)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        # The frame is dropped once the job is done, only the result is kept.
+        # A job whose lease expired and was taken over is left to its new owner.
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, frame = NULL, updated_at = ? WHERE id = ? AND worker_id = ?",
+                (status, json.dumps(result, default=str) if result is not None else None, error, time.time(), job_id, self.worker_id)
+            )
+            self._connection.commit()
+            self._changed.notify_all()
+
+    def _requeue(self, job_id, delay):
+        # Back in the queue, but not taken again for delay seconds, and the
+        # attempt doesn't count: the job never got to run
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, worker_id = NULL, available_at = ?, updated_at = ? WHERE id = ? AND worker_id = ?",
+                (now + delay, now, job_id, self.worker_id)
+            )
+            self._connection.commit()
+            self._changed.notify_all()
+
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        job_id, owner_id, status, result, error, attempts, created_at, updated_at = row
+        job = {
+            'job_id': job_id,
+            'owner_id': owner_id,
+            'status': status,
+            'attempts': attempts,
+            'created_at': created_at,
+            'updated_at': updated_at
+        }
+        if result is not None:
+            job['result'] = json.loads(result)
+        if error is not None:
+            job['error'] = error
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, owner_id, status, result, error, attempts, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        return self._row_to_job(row)
+
+    def wait(self, job_id, timeout):
+        # Long poll: return as soon as the job is done or failed, or after timeout
+        deadline = time.monotonic() + timeout
+        job = self.get(job_id)
+        while job is not None and job['status'] in ('queued', 'running'):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Re-read at least every second in case another process finished it
+            with self._lock:
+                self._changed.wait(min(remaining, 1.0))
+            job = self.get(job_id)
+        return job
+
+    def cleanup(self):
+        self.requeue_expired()
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - self.retention_seconds,)
+            )
+            self._connection.commit()
+
+    def stats(self):
+        with self._lock:
+            rows = self._connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        counts.update(dict(rows))
+        return {'jobs': counts, 'workers': len(self._threads), 'max_pending': self.max_pending}
+
+    def start(self, handler, workers=2, retry_on=(), max_attempts=5):
+        # handler(job) returns the JSON result. Exceptions in retry_on (with an
+        # optional retry_after in seconds) put the job back in the queue as often
+        # as needed. max_attempts only limits jobs whose lease expired, e.g. when
+        # their server stopped, so a frame that crashes it isn't retried forever.
+        def loop():
+            last_cleanup = time.monotonic()
+            while True:
+                if time.monotonic() - last_cleanup > 60:
+                    self.cleanup()
+                    last_cleanup = time.monotonic()
+                job = self._claim(timeout=30)
+                if job is None:
+                    continue
+                if job['attempts'] > max_attempts:
+                    self._finish(job['id'], 'failed', error=f"Gave up after {max_attempts} attempts")
+                    continue
+                try:
+                    self._finish(job['id'], 'done', result=handler(job))
+                except retry_on as e:
+                    self._requeue(job['id'], getattr(e, 'retry_after', 1))
+                except Exception as e:
+                    print(f"Error in frame job {job['id']}: {str(e)}")
+                    self._finish(job['id'], 'failed', error=str(e))
+
+        for number in range(workers):
+            thread = threading.Thread(target=loop, name=f'frame-jobs-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        threading.Thread(target=self._heartbeat, name='frame-jobs-heartbeat', daemon=True).start()
+        return self
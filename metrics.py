@@ -0,0 +1,128 @@
+import bisect
+import threading
+
+# Latency buckets in seconds, from a fast Mongo write to a slow detector
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(key)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        # Per label set: counts per bucket (last one is +Inf) and the sum
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{format_labels(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{format_labels(key)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name, help_text, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, help_text, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, help_text):
+        return self._register(Counter, name, help_text)
+
+    def gauge(self, name, help_text):
+        return self._register(Gauge, name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help_text, buckets=buckets)
+
+    def render(self):
+        # Prometheus text exposition format
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Timings:
+    # Spans of one request, sent back as a Server-Timing header
+
+    def __init__(self):
+        self.spans = []
+
+    def add(self, name, seconds):
+        self.spans.append((name, seconds))
+
+    def header(self):
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.spans)
+
+
+# Process-wide metrics served on /metrics
+registry = MetricsRegistry()
+STAGE_SECONDS = registry.histogram('frame_stage_seconds', 'Time spent in each stage of frame processing')
+FACES_PER_FRAME = registry.histogram('frame_faces', 'Faces found per processed frame', buckets=(0, 1, 2, 4, 8, 16, 32, 64))
+FRAMES_TOTAL = registry.counter('frames_processed_total', 'Frames analyzed, by ingestion path')
+REQUESTS_TOTAL = registry.counter('http_requests_total', 'HTTP requests by endpoint and status')
+REQUEST_SECONDS = registry.histogram('http_request_duration_seconds', 'HTTP request latency by endpoint')
+SESSION_STATS_TOTAL = registry.counter('session_stats_total', 'Session stats requests by the data they were computed from')
+SESSION_STATS_STUDENTS = registry.histogram('session_stats_students', 'Students in a session stats response', buckets=(0, 1, 5, 10, 25, 50, 100, 250))
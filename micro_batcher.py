@@ -0,0 +1,85 @@
+import concurrent.futures
+import queue
+import threading
+import time
+
+
+class MicroBatcher:
+    # Collects inputs submitted by concurrent callers for up to window_ms (or until
+    # max_batch_size inputs are waiting), runs predict_batch once over all of them
+    # and hands every caller back its own slice of the outputs.
+
+    def __init__(self, predict_batch, max_batch_size=32, window_ms=10):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._thread = threading.Thread(target=self._loop, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, items):
+        future = concurrent.futures.Future()
+        if not items:
+            future.set_result([])
+            return future
+        self._requests.put((list(items), future))
+        return future
+
+    def run(self, items):
+        return self.submit(items).result()
+
+    def _collect(self):
+        pending = [self._requests.get()]
+        count = len(pending[0][0])
+        deadline = time.perf_counter() + self.window
+        while count < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(request)
+            count += len(request[0])
+        return pending
+
+    def _loop(self):
+        while True:
+            pending = self._collect()
+            items = [item for request_items, _ in pending for item in request_items]
+            try:
+                outputs = self.predict_batch(items)
+            except Exception as e:
+                if len(pending) == 1:
+                    pending[0][1].set_exception(e)
+                else:
+                    # Run each request on its own, so one bad input only fails its caller
+                    for request_items, future in pending:
+                        try:
+                            future.set_result(self.predict_batch(request_items))
+                        except Exception as request_error:
+                            future.set_exception(request_error)
+                continue
+
+            with self._lock:
+                self._batches += 1
+                self._items += len(items)
+
+            start = 0
+            for request_items, future in pending:
+                future.set_result(outputs[start:start + len(request_items)])
+                start += len(request_items)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self._batches,
+                'items': self._items,
+                'avg_batch_size': round(self._items / self._batches, 2) if self._batches else 0.0,
+                'max_batch_size': self.max_batch_size,
+                'window_ms': self.window * 1000.0
+            }
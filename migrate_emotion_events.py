@@ -0,0 +1,94 @@
+import bisect
+import datetime
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from emotion_store import build_emotion_event, ensure_emotion_counters, ensure_emotion_events, rebuild_session_counters
+
+# Moves the emotions_data and student_emotions arrays embedded in session
+# documents into the emotion_events time-series collection and builds the
+# per-session emotion counters from them.
+#
+#     python migrate_emotion_events.py
+#
+# Sessions are migrated one at a time and their arrays are removed once the
+# events are stored, so sessions already migrated are skipped on a re-run.
+# Events a crashed run stored for a session still holding its arrays are
+# deleted before it is migrated again, so run it before the new server
+# records into those sessions.
+
+BATCH_SIZE = 1000
+# The old code stamped both arrays with separate utcnow() calls
+IDENTIFIED_TOLERANCE = datetime.timedelta(seconds=1)
+
+
+def migrate_session(session, events_collection):
+    # student_emotions only holds the detections that were identified, so use it
+    # to flag the entries of emotions_data with the same student and emotion
+    # stored at (almost) the same time
+    identified = {}
+    for student_id, records in (session.get('student_emotions') or {}).items():
+        for record in records:
+            if record.get('timestamp') is not None:
+                identified.setdefault((student_id, record.get('emotion')), []).append(record['timestamp'])
+    for timestamps in identified.values():
+        timestamps.sort()
+
+    events = []
+    for record in session.get('emotions_data', []):
+        if 'timestamp' not in record or 'emotion' not in record:
+            continue
+        was_identified = False
+        timestamps = identified.get((record.get('student_id'), record['emotion']))
+        if timestamps:
+            # Each identified record flags one entry, the closest one in time
+            index = bisect.bisect_left(timestamps, record['timestamp'])
+            candidates = [i for i in (index - 1, index) if 0 <= i < len(timestamps)]
+            closest = min(candidates, key=lambda i: abs(timestamps[i] - record['timestamp']))
+            if abs(timestamps[closest] - record['timestamp']) <= IDENTIFIED_TOLERANCE:
+                del timestamps[closest]
+                was_identified = True
+        events.append(build_emotion_event(
+            session['_id'],
+            record.get('student_id'),
+            record['emotion'],
+            record.get('confidence'),
+            record['timestamp'],
+            identified=was_identified
+        ))
+
+    # Left over by an interrupted run, which didn't get to remove the arrays
+    events_collection.delete_many({'meta.session_id': session['_id']})
+    for start in range(0, len(events), BATCH_SIZE):
+        events_collection.insert_many(events[start:start + BATCH_SIZE], ordered=False)
+    return len(events)
+
+
+def main():
+    load_dotenv()
+    # Config reads the environment on import, so load it after the .env file
+    from config import Config
+
+    client = MongoClient(Config.MONGO_URI)
+    db = client[Config.MONGO_DB_NAME]
+    sessions_collection = db['sessions']
+    events_collection = ensure_emotion_events(db)
+    counters_collection = ensure_emotion_counters(db)
+
+    legacy_filter = {'$or': [{'emotions_data': {'$exists': True}}, {'student_emotions': {'$exists': True}}]}
+    migrated_sessions = 0
+    migrated_events = 0
+    for session in sessions_collection.find(legacy_filter, {'emotions_data': 1, 'student_emotions': 1}):
+        migrated_events += migrate_session(session, events_collection)
+        rebuild_session_counters(events_collection, counters_collection, session['_id'], Config.EMOTION_COUNTER_BUCKET_SECONDS)
+        sessions_collection.update_one(
+            {'_id': session['_id']},
+            {'$unset': {'emotions_data': '', 'student_emotions': ''}}
+        )
+        migrated_sessions += 1
+        print(f"Migrated session {session['_id']}")
+
+    print(f"Migrated {migrated_events} events from {migrated_sessions} sessions")
+
+
+if __name__ == '__main__':
+    main()
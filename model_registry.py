@@ -0,0 +1,133 @@
+import resource
+import threading
+import time
+import cv2
+import numpy as np
+from deepface import DeepFace
+from deepface.models.demography import Emotion, Gender
+from deepface.modules import preprocessing
+
+
+def current_rss_bytes():
+    # Resident set size of this process, falling back to the peak on non-Linux hosts
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ModelRegistry:
+    # Keeps the emotion, gender, recognition and detector models resident and warm.
+    # DeepFace caches built models process-wide, so once a model is loaded here
+    # every DeepFace call in a request reuses it.
+
+    def __init__(self, detector_backends=('mtcnn',), recognition_model='VGG-Face'):
+        self.detector_backends = [backend for backend in detector_backends if backend and backend != 'skip']
+        self.recognition_model = recognition_model
+        self._models = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        self._load('Emotion', 'facial_attribute', self._warm_up_attribute)
+        self._load('Gender', 'facial_attribute', self._warm_up_attribute)
+        self._load(self.recognition_model, 'facial_recognition', self._warm_up_recognition)
+        for backend in self.detector_backends:
+            self._load(backend, 'face_detector', self._warm_up_detector)
+        return self
+
+    def _load(self, model_name, task, warm_up):
+        key = (task, model_name)
+        with self._lock:
+            if key in self._models:
+                return self._models[key]
+
+            rss_before = current_rss_bytes()
+            started = time.perf_counter()
+            model = DeepFace.build_model(model_name=model_name, task=task)
+            loaded = time.perf_counter()
+            try:
+                warm_up(model)
+            except Exception as e:
+                print(f"Error warming up {model_name}: {e}")
+            warmed = time.perf_counter()
+
+            network = getattr(model, 'model', None)
+            self._models[key] = model
+            self._stats[key] = {
+                'task': task,
+                'model_name': model_name,
+                'load_seconds': round(loaded - started, 3),
+                'warmup_seconds': round(warmed - loaded, 3),
+                'rss_delta_bytes': current_rss_bytes() - rss_before,
+                'parameters': network.count_params() if hasattr(network, 'count_params') else None
+            }
+            return model
+
+    def _warm_up_attribute(self, model):
+        model.predict(np.zeros((1, 224, 224, 3), dtype=np.float32))
+
+    def _warm_up_recognition(self, model):
+        height, width = model.input_shape[1], model.input_shape[0]
+        model.forward(np.zeros((1, height, width, 3), dtype=np.float32))
+
+    def _warm_up_detector(self, model):
+        model.detect_faces(np.zeros((160, 160, 3), dtype=np.uint8))
+
+    def get(self, model_name, task='facial_attribute'):
+        return self._models.get((task, model_name)) or self._load(
+            model_name, task, self._warm_up_for(task)
+        )
+
+    def ensure_detector(self, detector_backend):
+        # Backends outside the preloaded list are loaded and warmed once on first use
+        if detector_backend and detector_backend != 'skip':
+            self.get(detector_backend, 'face_detector')
+
+    def _warm_up_for(self, task):
+        if task == 'facial_recognition':
+            return self._warm_up_recognition
+        if task == 'face_detector':
+            return self._warm_up_detector
+        return self._warm_up_attribute
+
+    def predict_emotion_gender(self, faces):
+        # Classify a list of RGB face crops from DeepFace.extract_faces with one
+        # forward pass per model, mirroring the preprocessing of DeepFace.analyze
+        if not faces:
+            return []
+        batch = np.concatenate([
+            preprocessing.resize_image(img=face[:, :, ::-1], target_size=(224, 224))
+            for face in faces
+        ]).astype(np.float32)
+        gray = np.stack([
+            cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (48, 48))
+            for img in batch
+        ])[..., np.newaxis]
+
+        emotion_predictions = self.get('Emotion').model(gray, training=False).numpy()
+        gender_predictions = self.get('Gender').model(batch, training=False).numpy()
+
+        results = []
+        for emotion_prediction, gender_prediction in zip(emotion_predictions, gender_predictions):
+            total = emotion_prediction.sum()
+            results.append({
+                'emotion': {
+                    label: float(100 * emotion_prediction[i] / total)
+                    for i, label in enumerate(Emotion.labels)
+                },
+                'dominant_emotion': Emotion.labels[int(np.argmax(emotion_prediction))],
+                'gender': {
+                    label: float(100 * gender_prediction[i])
+                    for i, label in enumerate(Gender.labels)
+                },
+                'dominant_gender': Gender.labels[int(np.argmax(gender_prediction))]
+            })
+        return results
+
+    def stats(self):
+        return {
+            'models': list(self._stats.values()),
+            'rss_bytes': current_rss_bytes()
+        }
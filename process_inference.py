@@ -0,0 +1,146 @@
+import atexit
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import cv2
+import numpy as np
+from multiprocessing import shared_memory
+
+# State of an inference worker process, set up once by init_worker
+_worker = {}
+
+
+def attach_slot(name):
+    # Workers map every slot once and keep it; the parent owns and unlinks them
+    shm = _worker['slots'].get(name)
+    if shm is None:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 has no track argument. Spawned workers share the
+            # parent's resource tracker, so registering the segment again is
+            # harmless, and the tracker still unlinks it if the parent crashes.
+            shm = shared_memory.SharedMemory(name=name)
+        _worker['slots'][name] = shm
+    return shm
+
+
+def init_worker(config, detector_backends, threads, counter):
+    # Pin the process to its own cores and size TensorFlow's and OpenCV's thread
+    # pools to them before any model runs
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) >= threads:
+            first = (index * threads) % len(cpus)
+            os.sched_setaffinity(0, (cpus + cpus)[first:first + threads])
+    cv2.setNumThreads(threads)
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except Exception as e:
+        print(f"Error setting TensorFlow threads in inference worker {index}: {e}")
+
+    # Imported here so the parent process never pays for them twice
+    from face_index import FaceIndex
+    from frame_pipeline import FramePipeline
+    from micro_batcher import MicroBatcher
+    from model_registry import ModelRegistry
+
+    model_registry = ModelRegistry(detector_backends=detector_backends, recognition_model=config['FACE_MODEL_NAME']).load()
+    # Each worker classifies its own frame's faces in one batch, without a window
+    emotion_batcher = MicroBatcher(model_registry.predict_emotion_gender, max_batch_size=config['EMOTION_BATCH_MAX_SIZE'], window_ms=0)
+    face_index = FaceIndex(None, model_name=config['FACE_MODEL_NAME'], detector_backend=config['FACE_DETECTOR_BACKEND'], threshold=config['FACE_MATCH_THRESHOLD'])
+    _worker.update({
+        'index': index,
+        'pipeline': FramePipeline(None, config, face_index, model_registry, None, emotion_batcher),
+        'face_index': face_index,
+        'slots': {}
+    })
+
+
+def worker_ready():
+    return os.getpid()
+
+
+def analyze_shared_frame(slot_name, shape, detector_backend, embed):
+    # Runs in a worker: preprocess, detect, classify and (optionally) embed the
+    # frame the parent left in shared memory. Only the small results are pickled back.
+    shm = attach_slot(slot_name)
+    full_img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    pipeline = _worker['pipeline']
+    preprocessed_img, _, _ = pipeline.preprocess_image(full_img)
+    emotions, faces = pipeline.analyze_emotion(preprocessed_img, detector_backend, encode_faces=False, full_img=full_img)
+    embeddings = _worker['face_index'].embed_crops(faces) if embed and faces else None
+    return emotions, preprocessed_img.shape[:2], embeddings
+
+
+class InferenceProcesses:
+    # A tier of worker processes with their own warm models, so detection and
+    # classification don't compete for the GIL with request handling. Frames
+    # are handed over through preallocated shared memory slots instead of being
+    # pickled. One slot per dispatching thread of the inference pool, so a slot
+    # is always free when a job starts.
+
+    def __init__(self, config, processes, slots, threads=None, detector_backends=('mtcnn',)):
+        self.processes = processes
+        self.threads = threads or max(1, (os.cpu_count() or 1) // processes)
+        # Frames wider than the slot are resized straight into it
+        self.max_dimension = config['ANALYSIS_MAX_DIMENSION'] or 4096
+        slot_bytes = self.max_dimension * self.max_dimension * 3
+        self._slots = queue.Queue()
+        self._owned = []
+        for _ in range(slots):
+            shm = shared_memory.SharedMemory(create=True, size=slot_bytes)
+            self._owned.append(shm)
+            self._slots.put(shm)
+
+        # Workers must not inherit TensorFlow's state, so they are spawned
+        context = multiprocessing.get_context('spawn')
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(dict(config), list(detector_backends), self.threads, context.Value('i', 0))
+        )
+        atexit.register(self.close)
+
+    def start(self):
+        # Spawn every worker and wait until its models are loaded
+        futures = [self._executor.submit(worker_ready) for _ in range(self.processes)]
+        return [future.result() for future in futures]
+
+    def analyze(self, img_array, detector_backend, embed=True):
+        # Returns the emotions with boxes on the detection frame, the detection
+        # frame's (height, width) and the face embeddings (or None)
+        shm = self._slots.get()
+        try:
+            height, width = img_array.shape[:2]
+            longest = max(height, width)
+            if longest > self.max_dimension:
+                factor = self.max_dimension / longest
+                shape = (max(int(height * factor), 1), max(int(width * factor), 1), 3)
+                frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                cv2.resize(img_array, (shape[1], shape[0]), dst=frame, interpolation=cv2.INTER_AREA)
+            else:
+                shape = (height, width, 3)
+                frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                np.copyto(frame, img_array)
+            del frame
+            return self._executor.submit(analyze_shared_frame, shm.name, shape, detector_backend, embed).result()
+        finally:
+            self._slots.put(shm)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for shm in self._owned:
+            try:
+                shm.close()
+                shm.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+        self._owned = []
@@ -0,0 +1,78 @@
+import argparse
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+# Recomputes the face embeddings stored on every user with the configured
+# recognition model. Run it after changing FACE_MODEL_NAME (or, with --all,
+# FACE_DETECTOR_BACKEND) or upgrading to a release that prepares faces
+# differently, and before restarting the server. The server also re-embeds
+# outdated users in the background at startup (FACE_REEMBED_ON_STARTUP), but
+# they can't be identified until it gets to them.
+#
+#     FACE_MODEL_NAME=Facenet512 python reembed_faces.py
+#     python reembed_faces.py --all --role student
+#
+# Users already embedded with the configured model are skipped unless --all is
+# given, so an interrupted run can simply be started again. With GALLERY_DIR set
+# the gallery files are rebuilt at the end.
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute the stored face embeddings of enrolled users')
+    parser.add_argument('--all', action='store_true', help='Re-embed users already embedded with the configured model')
+    parser.add_argument('--role', help='Only users with this role')
+    args = parser.parse_args()
+
+    load_dotenv()
+    # Config reads the environment on import, so load it after the .env file
+    from config import Config
+    from face_index import FaceIndex
+
+    client = MongoClient(Config.MONGO_URI)
+    users_collection = client[Config.MONGO_DB_NAME]['users']
+    face_index = FaceIndex(
+        users_collection,
+        model_name=Config.FACE_MODEL_NAME,
+        detector_backend=Config.FACE_DETECTOR_BACKEND,
+        threshold=Config.FACE_MATCH_THRESHOLD,
+        gallery_dir=Config.GALLERY_DIR or None,
+        ivf_min_rows=Config.GALLERY_IVF_MIN_ROWS,
+        ivf_lists=Config.GALLERY_IVF_LISTS
+    )
+
+    query = {'images.0': {'$exists': True}}
+    if args.role:
+        query['role'] = args.role
+    if not args.all:
+        query.update(face_index.outdated_query())
+
+    users = 0
+    images = 0
+    # Only the ids are read up front, the cursor would time out while embedding
+    user_ids = [user['_id'] for user in users_collection.find(query, {'_id': 1})]
+    for user_id in user_ids:
+        user = users_collection.find_one({'_id': user_id}, {'images': 1})
+        if user is None:
+            continue
+        entries = face_index.store_embeddings(user_id, user['images'])
+        users += 1
+        images += len(entries)
+        if len(entries) < len(user['images']):
+            print(f"User {user_id}: no face found in {len(user['images']) - len(entries)} of {len(user['images'])} images")
+        print(f"Embedded user {user_id} ({users}/{len(user_ids)})")
+
+    print(f"Stored {images} embeddings for {users} users with {face_index.model_name}")
+
+    # Rewrite the gallery files, so the server maps them instead of building them
+    if face_index.gallery_dir:
+        for role, gender in sorted(face_index.partition_keys()):
+            if args.role and role != args.role:
+                continue
+            sidecar = face_index.build_gallery(role, gender)
+            if sidecar:
+                search = 'IVF index' if sidecar['ivf_file'] else 'full scan'
+                print(f"Wrote gallery {role}/{gender}: {sidecar['count']} rows, {search}")
+
+
+if __name__ == '__main__':
+    main()
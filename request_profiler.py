@@ -0,0 +1,81 @@
+import datetime
+import os
+import sys
+import threading
+import time
+
+# Thread name prefixes of the shared workers a request waits on
+WORKER_THREAD_PREFIXES = ('inference', 'micro-batcher')
+
+
+class SlowRequestProfiler:
+    # Samples the stacks of in-flight requests every interval and, when a
+    # request turns out slower than the threshold, writes its samples as
+    # collapsed stacks (one "frame;frame;frame count" line each, the input of
+    # flamegraph tools). Stacks of the shared inference workers are sampled
+    # alongside, since that is where a frame spends most of its time.
+
+    def __init__(self, output_dir='profiles', slow_seconds=1.0, interval_ms=5, max_depth=40):
+        self.output_dir = output_dir
+        self.slow_seconds = slow_seconds
+        self.interval = interval_ms / 1000.0
+        self.max_depth = max_depth
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name='request-profiler', daemon=True)
+        self._thread.start()
+
+    def start(self):
+        # Begin sampling the calling (request) thread
+        with self._lock:
+            self._active[threading.get_ident()] = (time.perf_counter(), {})
+
+    def stop(self, name):
+        # Returns the path of the written profile, or None when the request was fast
+        with self._lock:
+            started, samples = self._active.pop(threading.get_ident(), (None, None))
+        if started is None:
+            return None
+        duration = time.perf_counter() - started
+        if duration < self.slow_seconds or not samples:
+            return None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        path = os.path.join(self.output_dir, f"{timestamp}-{name.replace('/', '_')}.folded")
+        with open(path, 'w') as profile_file:
+            for stack, count in sorted(samples.items(), key=lambda item: -item[1]):
+                profile_file.write(f'{stack} {count}\n')
+        print(f"Slow request {name} took {duration:.2f}s, profile written to {path}")
+        return path
+
+    def _stack(self, frame, thread_name):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        names.append(thread_name)
+        return ';'.join(reversed(names))
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+            frames = sys._current_frames()
+            threads = {thread.ident: thread.name for thread in threading.enumerate()}
+            workers = [
+                self._stack(frame, threads[ident])
+                for ident, frame in frames.items()
+                if threads.get(ident, '').startswith(WORKER_THREAD_PREFIXES)
+            ]
+            # Requests that finished meanwhile are no longer in _active
+            with self._lock:
+                for ident, (_, samples) in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    for stack in [self._stack(frame, 'request')] + workers:
+                        samples[stack] = samples.get(stack, 0) + 1
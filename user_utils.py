@@ -1,12 +1,29 @@
-from deepface import DeepFace
 from datetime import datetime
-import os
 from bson.objectid import ObjectId
 import jwt
 from functools import wraps
 from flask import request, jsonify
-import numpy as np
 import time
+from ttl_cache import TTLCache
+from face_index import EMBEDDINGS_FIELD
+
+# Projected records of recently authenticated users, keyed by user id
+user_cache = TTLCache()
+USER_CACHE_PROJECTION = {"role": 1, "name": 1, "last_name": 1, "email": 1, "gender": 1}
+# Users sent back to clients, without the stored face embeddings
+PUBLIC_USER_PROJECTION = {EMBEDDINGS_FIELD: 0}
+
+def load_user_from_token(db, secret_key, token):
+    # Verify the JWT and return the cached projection of its user.
+    # Raises when the token is invalid or expired.
+    data = jwt.decode(token, secret_key, algorithms=['HS256'])
+    current_user = user_cache.get(data['user_id'])
+    if current_user is None:
+        current_user = db['users'].find_one({"_id": ObjectId(data['user_id'])}, USER_CACHE_PROJECTION)
+        if current_user:
+            user_cache.set(data['user_id'], current_user)
+    # Hand out a copy so callers can't modify the cached record
+    return dict(current_user) if current_user else current_user
 
 def token_required(db, secret_key):
     def decorator(f):
@@ -18,8 +35,7 @@ def token_required(db, secret_key):
             if not token:
                 return jsonify({"error": "Token is missing!"}), 401
             try:
-                data = jwt.decode(token, secret_key, algorithms=['HS256'])
-                current_user = db['users'].find_one({"_id": ObjectId(data['user_id'])})
+                current_user = load_user_from_token(db, secret_key, token)
             except:
                 return jsonify({"error": "Token is invalid!"}), 401
             return f(current_user, *args, **kwargs)
@@ -43,39 +59,39 @@ def is_self(f):
         return f(current_user, *args, **kwargs)
     return decorated_function
 
-def identify_users(image_path, users_collection):
+def identify_users(image_path, face_index, users_collection):
     try:
-        results = DeepFace.find(img_path=image_path, db_path="user_images", enforce_detection=False)
+        embeddings = face_index.embed_faces(image_path)
+        if embeddings is None:
+            return []
+
+        matched_ids = []
+        for match in face_index.match_any(embeddings):
+            if match and match[0] not in matched_ids:
+                matched_ids.append(match[0])
+
         identified_users = []
-        seen_users = set()
-        
-        for result in results:
-            user_image_path = result['identity'][0]
-            user = users_collection.find_one({"images": user_image_path})
-            
-            if user:
-                user_id = str(user['_id'])  # Convert ObjectId to string
-                if user_id not in seen_users:
-                    user['_id'] = str(user['_id'])
-                    identified_users.append(user)
-                    seen_users.add(user_id)
+        for user in users_collection.find({"_id": {"$in": matched_ids}}, PUBLIC_USER_PROJECTION):
+            user['_id'] = str(user['_id'])  # Convert ObjectId to string
+            identified_users.append(user)
 
         return identified_users
     except Exception as e:
         print(f"Error identifying users: {e}")
         return []
 
-def identify_user(image_path, users_collection, gender, role):
+def identify_user(image_path, face_index, users_collection, gender, role):
     try:
-        # Construct the image path based on role and gender
-        db_path = f"user_images/{role}/{gender}"
-        
-        results = DeepFace.find(img_path=image_path, db_path=db_path, enforce_detection=False)
+        # Match against the resident gallery for this role and gender
+        embedding = face_index.embed_image(image_path)
+        if embedding is None:
+            return None
+
+        match = face_index.match(embedding, role, gender)[0]
         identified_user = None
 
-        if results:
-            user_image_path = results[0]['identity'][0]
-            user = users_collection.find_one({"images": user_image_path})
+        if match:
+            user = users_collection.find_one({"_id": match[0]}, PUBLIC_USER_PROJECTION)
             
             if user:
                 user['_id'] = str(user['_id'])
@@ -86,14 +102,70 @@ def identify_user(image_path, users_collection, gender, role):
         print(f"Error identifying user: {e}")
         return None
 
+def identify_faces(face_arrays, genders, face_index, users_collection, role, identity_cache=None, embeddings=None):
+    # Identify every face crop of a frame at once: one batched embedding pass,
+    # one gallery match per gender partition and a single $in lookup.
+    # With an identity cache, faces are first matched against the session's
+    # small set of known embeddings and only misses reach the gallery.
+    # Embeddings already computed for every face (by an inference process)
+    # replace the embedding pass.
+    identified = [None] * len(genders)
+    try:
+        if embeddings is None:
+            # Skip empty crops from boxes that fall outside the frame
+            valid = [i for i, face in enumerate(face_arrays) if face is not None and face.size > 0]
+            if not valid:
+                return identified
+            embeddings = face_index.embed_crops([face_arrays[i] for i in valid])
+        else:
+            valid = list(range(len(embeddings)))
+            if not valid:
+                return identified
+
+        matched_ids = [None] * len(genders)
+        pending = list(range(len(valid)))
+        if identity_cache is not None:
+            for row, user_id in enumerate(identity_cache.match(embeddings)):
+                matched_ids[valid[row]] = user_id
+            pending = [row for row in pending if matched_ids[valid[row]] is None]
+
+        resolved = []
+        for gender in set(genders[valid[row]] for row in pending):
+            rows = [row for row in pending if genders[valid[row]] == gender]
+            for row, match in zip(rows, face_index.match(embeddings[rows], role, gender)):
+                if match:
+                    matched_ids[valid[row]] = match[0]
+                    resolved.append(row)
+
+        if identity_cache is not None and resolved:
+            identity_cache.add(embeddings[resolved], [matched_ids[valid[row]] for row in resolved])
+
+        wanted = list({user_id for user_id in matched_ids if user_id is not None})
+        if not wanted:
+            return identified
+
+        users = {}
+        for user in users_collection.find({"_id": {"$in": wanted}}, PUBLIC_USER_PROJECTION):
+            users[user['_id']] = user
+            user['_id'] = str(user['_id'])
+
+        for i, user_id in enumerate(matched_ids):
+            if user_id is not None:
+                identified[i] = users.get(user_id)
+        return identified
+    except Exception as e:
+        print(f"Error identifying faces: {e}")
+        return identified
+
 def save_emotions_to_user(person_id, emotions, users_collection):
-    for emotion_data in emotions:
-        emotion_record = {
-            "timestamp": datetime.utcnow(),
-            "emotion": emotion_data['emotion'],
-            "confidence": emotion_data['confidence']
-        }
-        users_collection.update_one(
-            {"_id": person_id},
-            {"$push": {"emotions": emotion_record}}
-        )
\ No newline at end of file
+    emotion_records = [{
+        "timestamp": datetime.utcnow(),
+        "emotion": emotion_data['emotion'],
+        "confidence": emotion_data['confidence']
+    } for emotion_data in emotions]
+    if not emotion_records:
+        return
+    users_collection.update_one(
+        {"_id": person_id},
+        {"$push": {"emotions": {"$each": emotion_records}}}
+    )
\ No newline at end of file
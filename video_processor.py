@@ -0,0 +1,243 @@
+import collections
+import concurrent.futures
+import datetime
+import os
+import threading
+import time
+import uuid
+import cv2
+from bson.objectid import ObjectId
+from emotion_store import save_emotion_batch
+from inference_pool import InferencePoolFull
+from metrics import FRAMES_TOTAL
+
+
+class VideoProcessor:
+    # Analyzes recorded class videos in the background. The file is decoded as
+    # a stream, one frame every 1 / sample_fps seconds is sent through the frame
+    # pipeline by a few parallel workers, and the results are stored in batches
+    # in video order. Every batch moves the job's checkpoint, so an interrupted
+    # job resumes after the last stored frame.
+    #
+    # A job belongs to the server process that runs it (worker_id), which
+    # refreshes heartbeat_at on all its queued and running jobs. Jobs whose
+    # heartbeat went stale lost their process: they are picked up again at
+    # startup and can be resumed, while a slow but live job can't be.
+
+    def __init__(self, db, config, frame_pipeline):
+        self.jobs_collection = db['video_jobs']
+        self.frame_pipeline = frame_pipeline
+        self.upload_dir = config['VIDEO_UPLOAD_DIR']
+        self.workers = config['VIDEO_WORKERS']
+        self.batch_frames = config['VIDEO_BATCH_FRAMES']
+        self.stale_seconds = config['VIDEO_STALE_SECONDS']
+        self.worker_id = uuid.uuid4().hex
+        # At most this many videos decode at once, each with its own workers
+        self._running = threading.BoundedSemaphore(config['VIDEO_MAX_CONCURRENT'])
+        os.makedirs(self.upload_dir, exist_ok=True)
+        threading.Thread(target=self._heartbeat, name='video-heartbeat', daemon=True).start()
+        self.recover()
+
+    def _heartbeat(self):
+        # Keeps going through database errors: a dead heartbeat would let another
+        # process take over jobs that are still running here
+        while True:
+            try:
+                self.jobs_collection.update_many(
+                    {'worker_id': self.worker_id, 'status': {'$in': ['queued', 'running']}},
+                    {'$set': {'heartbeat_at': datetime.datetime.utcnow()}}
+                )
+            except Exception as e:
+                print(f"Error renewing video job heartbeats: {str(e)}")
+            time.sleep(self.stale_seconds / 4)
+
+    def _orphaned(self):
+        # Queued or running jobs whose process stopped refreshing them, or that
+        # were created before jobs had a heartbeat
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.stale_seconds)
+        return {
+            'status': {'$in': ['queued', 'running']},
+            '$or': [{'heartbeat_at': {'$lt': stale}}, {'heartbeat_at': {'$exists': False}}]
+        }
+
+    def _claim(self, query):
+        # Take the job over for this process and queue it; None when it isn't eligible
+        now = datetime.datetime.utcnow()
+        return self.jobs_collection.find_one_and_update(
+            query,
+            {'$set': {'status': 'queued', 'worker_id': self.worker_id, 'heartbeat_at': now, 'updated_at': now}, '$unset': {'error': ''}}
+        )
+
+    def recover(self):
+        # Restart the jobs left behind by a stopped server from their checkpoints
+        recovered = 0
+        while True:
+            job = self._claim(self._orphaned())
+            if job is None:
+                break
+            self.start(job['_id'])
+            recovered += 1
+        if recovered:
+            print(f"Resuming {recovered} interrupted video jobs")
+        return recovered
+
+    def create(self, owner_id, session_id, student_id, upload, sample_fps, detector_backend, started_at):
+        # Stream the upload to disk and queue its job
+        job_id = ObjectId()
+        path = os.path.join(self.upload_dir, f'{job_id}.video')
+        upload.save(path)
+
+        capture = cv2.VideoCapture(path)
+        opened = capture.isOpened()
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        capture.release()
+        if not opened:
+            os.remove(path)
+            raise ValueError("The file is not a readable video")
+
+        now = datetime.datetime.utcnow()
+        self.jobs_collection.insert_one({
+            '_id': job_id,
+            'owner_id': owner_id,
+            'session_id': ObjectId(session_id),
+            'student_id': student_id,
+            'path': path,
+            'status': 'queued',
+            'sample_fps': sample_fps,
+            'detector_backend': detector_backend,
+            'started_at': started_at or now,
+            'fps': fps,
+            'frame_count': frame_count,
+            # Index of the last frame whose results are stored
+            'checkpoint_frame': -1,
+            'frames_processed': 0,
+            'faces': 0,
+            'worker_id': self.worker_id,
+            'heartbeat_at': now,
+            'created_at': now,
+            'updated_at': now
+        })
+        self.start(job_id)
+        return job_id
+
+    def get(self, job_id):
+        return self.jobs_collection.find_one({'_id': ObjectId(job_id)}, {'path': 0, 'worker_id': 0})
+
+    def resume(self, job_id):
+        # Failed, or queued or running in a server that stopped. A live job keeps
+        # its heartbeat fresh, so it never runs in two threads.
+        job = self._claim({
+            '_id': ObjectId(job_id),
+            '$or': [{'status': 'failed'}, self._orphaned()]
+        })
+        if job is None:
+            return False
+        self.start(job['_id'])
+        return True
+
+    def start(self, job_id):
+        thread = threading.Thread(target=self._run, args=(job_id,), name=f'video-{job_id}', daemon=True)
+        thread.start()
+
+    def _update(self, job_id, fields):
+        fields['updated_at'] = datetime.datetime.utcnow()
+        self.jobs_collection.update_one({'_id': job_id}, {'$set': fields})
+
+    def _analyze(self, img_array, detector_backend, session_id):
+        # Wait for room on the shared inference pool rather than dropping frames
+        while True:
+            try:
+                emotions, _, _ = self.frame_pipeline.analyze_frame(img_array, detector_backend, encode_faces=False, session_id=session_id)
+                return emotions
+            except InferencePoolFull as e:
+                time.sleep(e.retry_after)
+
+    def _run(self, job_id):
+        with self._running:
+            job = self.jobs_collection.find_one_and_update(
+                {'_id': job_id, 'status': 'queued', 'worker_id': self.worker_id},
+                {'$set': {'status': 'running', 'updated_at': datetime.datetime.utcnow()}}
+            )
+            if job is None:
+                return
+            try:
+                self._process(job)
+                self._update(job_id, {'status': 'done', 'progress': 1.0})
+                os.remove(job['path'])
+            except Exception as e:
+                print(f"Error processing video {job_id}: {str(e)}")
+                self._update(job_id, {'status': 'failed', 'error': str(e)})
+
+    def _process(self, job):
+        capture = cv2.VideoCapture(job['path'])
+        if not capture.isOpened():
+            raise ValueError("The video file can't be opened")
+        try:
+            fps = job['fps'] or 30.0
+            step = max(1, round(fps / job['sample_fps']))
+            session_id = str(job['session_id'])
+            detector_backend = self.frame_pipeline.resolve_detector(job['detector_backend'])
+            frames_processed = job['frames_processed']
+            faces = job['faces']
+
+            # Skip what is already stored; grab() advances without decoding
+            index = job['checkpoint_frame'] + 1
+            if index > 0 and not capture.set(cv2.CAP_PROP_POS_FRAMES, index):
+                for _ in range(index):
+                    capture.grab()
+
+            in_flight = collections.deque()
+            batch = []
+            last_index = job['checkpoint_frame']
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='video-worker') as executor:
+                while True:
+                    if index % step:
+                        ok = capture.grab()
+                    else:
+                        ok, img_array = capture.read()
+                        if ok:
+                            timestamp = job['started_at'] + datetime.timedelta(seconds=index / fps)
+                            future = executor.submit(self._analyze, img_array, detector_backend, session_id)
+                            in_flight.append((index, timestamp, future))
+                    if not ok:
+                        break
+                    index += 1
+
+                    # Keep a bounded window of frames in flight and collect them in order
+                    while len(in_flight) >= self.workers * 2:
+                        last_index = self._collect(in_flight, batch)
+                    if len(batch) >= self.batch_frames:
+                        frames_processed, faces = self._flush(job, batch, last_index, frames_processed, faces)
+
+                while in_flight:
+                    last_index = self._collect(in_flight, batch)
+                if batch:
+                    self._flush(job, batch, last_index, frames_processed, faces)
+        finally:
+            capture.release()
+
+    def _collect(self, in_flight, batch):
+        frame_index, timestamp, future = in_flight.popleft()
+        batch.append((timestamp, future.result()))
+        return frame_index
+
+    def _flush(self, job, batch, last_index, frames_processed, faces):
+        # One bulk write for the batch, then move the checkpoint past it
+        save_emotion_batch(
+            self.frame_pipeline.emotion_events_collection,
+            self.frame_pipeline.emotion_counters_collection,
+            str(job['session_id']),
+            job['student_id'],
+            batch,
+            self.frame_pipeline.counter_bucket_seconds
+        )
+        FRAMES_TOTAL.inc(len(batch), source='video')
+        frames_processed += len(batch)
+        faces += sum(len(emotions) for _, emotions in batch)
+        fields = {'checkpoint_frame': last_index, 'frames_processed': frames_processed, 'faces': faces}
+        if job['frame_count']:
+            fields['progress'] = round(min((last_index + 1) / job['frame_count'], 1.0), 4)
+        self._update(job['_id'], fields)
+        batch.clear()
+        return frames_processed, faces